@@ -0,0 +1,306 @@
+"""Versioned JSON read API, mounted at /api/v1.
+
+Responses are built from plain row tuples (only the selected columns are
+fetched, no ORM objects) and serialized with orjson when it's installed.
+
+    GET /api/v1/timeline                  home timeline (login required)
+    GET /api/v1/users?ids=1,2,3           batch of users, one query
+    GET /api/v1/users/<id>                one user
+    GET /api/v1/users/<id>/messages       their messages
+    GET /api/v1/users/<id>/likes          messages they liked
+    GET /api/v1/users/<id>/followers      (login required)
+    GET /api/v1/users/<id>/following      (login required)
+    GET /api/v1/messages?ids=1,2,3        batch of messages, one query
+    GET /api/v1/messages/<id>             one message
+
+Every endpoint takes ?fields=a,b,c to return only those fields. Lists
+come back as {"items": [...], "next": cursor}; pass the cursor back as
+?before= for the next page, and ?limit= for smaller pages.
+"""
+
+import json
+from datetime import datetime
+
+from flask import Blueprint, Response, abort, g, request
+
+from models import db, User, Message, Likes, Follows, HomeTimeline
+from pagination import keyset_page, MESSAGES_PER_PAGE, USERS_PER_PAGE
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+MAX_BATCH = 100
+
+USER_FIELDS = {
+    'id': User.id,
+    'username': User.username,
+    'image_url': User.image_url,
+    'header_image_url': User.header_image_url,
+    'bio': User.bio,
+    'location': User.location,
+    'messages_count': User.messages_count,
+    'following_count': User.following_count,
+    'followers_count': User.followers_count,
+    'likes_count': User.likes_count,
+}
+
+# Author fields are flattened into each message and joined in only when
+# one of them is selected.
+MESSAGE_FIELDS = {
+    'id': Message.id,
+    'text': Message.text,
+    'timestamp': Message.timestamp,
+    'user_id': Message.user_id,
+    'username': User.username,
+    'user_image_url': User.image_url,
+}
+
+AUTHOR_FIELDS = {'username', 'user_image_url'}
+
+api = Blueprint('api_v1', __name__, url_prefix='/api/v1')
+
+
+def dumps(payload):
+    if orjson:
+        return orjson.dumps(payload)
+
+    return json.dumps(payload, default=lambda value: value.isoformat()
+                      if isinstance(value, datetime) else str(value))
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload), status=status, mimetype='application/json')
+
+
+@api.errorhandler(400)
+@api.errorhandler(401)
+@api.errorhandler(404)
+def api_error(err):
+    return json_response({'error': err.description}, err.code)
+
+
+def login_required():
+    if not g.user:
+        abort(401, "login required")
+
+
+def selected_fields(available):
+    """The fields asked for with ?fields=, or all of them."""
+
+    fields = request.args.get('fields')
+    if not fields:
+        return list(available)
+
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    if not names:
+        abort(400, "no fields selected")
+
+    unknown = set(names) - set(available)
+    if unknown:
+        abort(400, f"unknown fields: {', '.join(sorted(unknown))}")
+
+    return names
+
+
+def requested_ids():
+    """The ids in ?ids=1,2,3, in order, without duplicates."""
+
+    try:
+        ids = [int(value) for value in request.args.get('ids', '').split(',')
+               if value.strip()]
+    except ValueError:
+        abort(400, "ids must be integers")
+
+    if not ids:
+        abort(400, "ids required")
+    if len(ids) > MAX_BATCH:
+        abort(400, f"at most {MAX_BATCH} ids")
+
+    return list(dict.fromkeys(ids))
+
+
+def page_size(maximum):
+    """The page size asked for with ?limit=, at most `maximum`."""
+
+    try:
+        limit = int(request.args.get('limit', maximum))
+    except ValueError:
+        abort(400, "limit must be an integer")
+
+    return max(1, min(limit, maximum))
+
+
+def user_query(fields):
+    return (db.session.query(*(USER_FIELDS[name] for name in fields))
+            .select_from(User)
+            .filter(User.deleted_at.is_(None)))
+
+
+def message_query(fields, extra=()):
+    """Query for `fields` of messages, plus `extra` columns after them."""
+
+    query = (db.session.query(*(MESSAGE_FIELDS[name] for name in fields), *extra)
+             .select_from(Message)
+             .filter(Message.user_id.notin_(User.hidden_ids())))
+    if AUTHOR_FIELDS & set(fields):
+        query = query.join(User, User.id == Message.user_id)
+    return query
+
+
+def as_dicts(rows, fields):
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def message_list(query_for, fields, columns):
+    """Page of messages from `query_for(fields, columns)`, keyed on `columns`.
+
+    The sort columns are fetched after the selected fields (whether or not
+    they were asked for), so the cursor can be built from each row.
+    """
+
+    width = len(fields)
+    page = keyset_page(
+        query_for(fields, columns),
+        columns=columns,
+        key=lambda row: tuple(row[width:]),
+        before=request.args.get('before'),
+        per_page=page_size(MESSAGES_PER_PAGE),
+    )
+    return json_response({
+        'items': [dict(zip(fields, row[:width])) for row in page.items],
+        'next': page.next_cursor,
+    })
+
+
+def user_list(query, fields, columns=(User.id,)):
+    """Page of users from `query`, keyed on `columns`; newest accounts first."""
+
+    width = len(fields)
+    page = keyset_page(
+        query.add_columns(*columns),
+        columns=columns,
+        key=lambda row: tuple(row[width:]),
+        before=request.args.get('before'),
+        per_page=page_size(USERS_PER_PAGE),
+    )
+    return json_response({
+        'items': [dict(zip(fields, row[:width])) for row in page.items],
+        'next': page.next_cursor,
+    })
+
+
+##############################################################################
+# Users
+
+@api.route('/users')
+def users_batch():
+    fields = selected_fields(USER_FIELDS)
+    ids = requested_ids()
+
+    rows = user_query(fields).add_columns(User.id).filter(User.id.in_(ids)).all()
+    by_id = {row[-1]: row[:-1] for row in rows}
+
+    return json_response({'items': as_dicts(
+        (by_id[user_id] for user_id in ids if user_id in by_id), fields)})
+
+
+@api.route('/users/<int:user_id>')
+def user_detail(user_id):
+    fields = selected_fields(USER_FIELDS)
+    row = user_query(fields).filter(User.id == user_id).first()
+    if row is None:
+        abort(404, "no such user")
+
+    return json_response(dict(zip(fields, row)))
+
+
+@api.route('/users/<int:user_id>/messages')
+def user_messages(user_id):
+    return message_list(
+        lambda fields, columns: (message_query(fields, columns)
+                                 .filter(Message.user_id == user_id)),
+        selected_fields(MESSAGE_FIELDS),
+        (Message.timestamp, Message.id),
+    )
+
+
+@api.route('/users/<int:user_id>/likes')
+def user_likes(user_id):
+    return message_list(
+        lambda fields, columns: (message_query(fields, columns)
+                                 .join(Likes, Likes.message_id == Message.id)
+                                 .filter(Likes.user_id == user_id)),
+        selected_fields(MESSAGE_FIELDS),
+        (Message.timestamp, Message.id),
+    )
+
+
+@api.route('/users/<int:user_id>/followers')
+def user_followers(user_id):
+    login_required()
+    fields = selected_fields(USER_FIELDS)
+
+    return user_list(
+        user_query(fields)
+        .join(Follows, Follows.user_following_id == User.id)
+        .filter(Follows.user_being_followed_id == user_id),
+        fields,
+        # newest follow first, as on the site's followers page
+        (Follows.created_at, Follows.user_following_id),
+    )
+
+
+@api.route('/users/<int:user_id>/following')
+def user_following(user_id):
+    login_required()
+    fields = selected_fields(USER_FIELDS)
+
+    return user_list(
+        user_query(fields)
+        .join(Follows, Follows.user_being_followed_id == User.id)
+        .filter(Follows.user_following_id == user_id),
+        fields,
+        # newest follow first, as on the site's following page
+        (Follows.created_at, Follows.user_being_followed_id),
+    )
+
+
+##############################################################################
+# Messages
+
+@api.route('/timeline')
+def timeline():
+    login_required()
+
+    return message_list(
+        lambda fields, columns: (message_query(fields, columns)
+                                 .join(HomeTimeline,
+                                       HomeTimeline.message_id == Message.id)
+                                 .filter(HomeTimeline.user_id == g.user.id)),
+        selected_fields(MESSAGE_FIELDS),
+        (HomeTimeline.timestamp, HomeTimeline.message_id),
+    )
+
+
+@api.route('/messages')
+def messages_batch():
+    fields = selected_fields(MESSAGE_FIELDS)
+    ids = requested_ids()
+
+    rows = message_query(fields, (Message.id,)).filter(Message.id.in_(ids)).all()
+    by_id = {row[-1]: row[:-1] for row in rows}
+
+    return json_response({'items': as_dicts(
+        (by_id[message_id] for message_id in ids if message_id in by_id), fields)})
+
+
+@api.route('/messages/<int:message_id>')
+def message_detail(message_id):
+    fields = selected_fields(MESSAGE_FIELDS)
+    row = message_query(fields).filter(Message.id == message_id).first()
+    if row is None:
+        abort(404, "no such message")
+
+    return json_response(dict(zip(fields, row)))
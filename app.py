@@ -1,11 +1,23 @@
 import os
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (Flask, render_template, stream_template, request, flash, redirect,
+                   session, g, url_for, jsonify, get_flashed_messages, abort)
 from flask_debugtoolbar import DebugToolbarExtension
 from sqlalchemy.exc import IntegrityError
 
+from api import api
+from db_pool import engine_options
 from forms import UserAddForm, LoginForm, MessageForm, UserEditForm
-from models import db, connect_db, User, Message, Likes
+from fragment_cache import FragmentCache
+from jobs import enqueue, register_commands as register_job_commands
+from http_cache import apply_cache_policy, not_modified
+from metrics import init_metrics
+from migrations import register_commands
+from models import db, bcrypt, connect_db, User, Message, Likes, Follows, HomeTimeline
+from pagination import keyset_page, Page, USERS_PER_PAGE
+from passwords import PasswordHasherBusy
+from replicas import init_replicas, read_replica, replica_binds
+from user_cache import UserSnapshot, make_user_cache
 
 CURR_USER_KEY = "curr_user"
 
@@ -16,13 +28,67 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = (
     os.environ.get('DATABASE_URL', 'postgresql:///warbler'))
 
+# Connection pool for each engine, and whether DATABASE_URL is PgBouncer
+# in transaction pooling mode; see db_pool.py.
+app.config['DB_PGBOUNCER'] = os.environ.get('DB_PGBOUNCER', '0') == '1'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(
+    app.config['SQLALCHEMY_DATABASE_URI'],
+    pool_size=int(os.environ.get('DB_POOL_SIZE', 5)),
+    max_overflow=int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    recycle=int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    pre_ping=os.environ.get('DB_POOL_PRE_PING', '1') == '1',
+    pgbouncer=app.config['DB_PGBOUNCER'],
+)
+
+# Optional read replicas for the read-only pages, and how long a client
+# stays on the primary after writing; see replicas.py.
+app.config['SQLALCHEMY_BINDS'] = replica_binds(
+    os.environ.get('DATABASE_REPLICA_URLS', ''))
+app.config['REPLICA_STICKY_SECONDS'] = float(
+    os.environ.get('REPLICA_STICKY_SECONDS', 5))
+
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = False
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', "it's a secret")
+
+# Logged-in users are cached for USER_CACHE_TTL seconds (0 disables it),
+# in-process or, if USER_CACHE_SOCKET is set, in a user_cache.py server
+# shared by all workers.
+app.config['USER_CACHE_TTL'] = float(os.environ.get('USER_CACHE_TTL', 30))
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE', 10_000))
+app.config['USER_CACHE_SOCKET'] = os.environ.get('USER_CACHE_SOCKET')
+
+# Rendered message cards kept per process (0 disables); see fragment_cache.py.
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE', 50_000))
+
+# bcrypt cost, and how many hashes may run (and wait) at once; see
+# passwords.py. Existing passwords move to a new cost as users log in.
+app.config['BCRYPT_LOG_ROUNDS'] = int(os.environ.get('BCRYPT_LOG_ROUNDS', 12))
+app.config['BCRYPT_WORKERS'] = int(os.environ.get('BCRYPT_WORKERS', os.cpu_count() or 1))
+app.config['BCRYPT_QUEUE_LIMIT'] = int(os.environ.get('BCRYPT_QUEUE_LIMIT', 16))
+
+# Part of every page ETag; set RELEASE per deploy so template changes
+# aren't hidden behind 304s.
+app.config['ETAG_VERSION'] = os.environ.get('RELEASE', '1')
 toolbar = DebugToolbarExtension(app)
 
 connect_db(app)
+init_metrics(app, db, bcrypt)
+init_replicas(app, db)
+register_commands(app)
+register_job_commands(app)
+app.register_blueprint(api)
+user_cache = make_user_cache(app.config)
+fragment_cache = FragmentCache(app.config['FRAGMENT_CACHE_SIZE'])
+
+
+@app.template_global()
+def message_card(msg):
+    """Markup for a message's card, shared by every viewer."""
+
+    return fragment_cache.render_card(app.jinja_env, msg)
 
 
 ##############################################################################
@@ -31,13 +97,85 @@ connect_db(app)
 
 @app.before_request
 def add_user_to_g():
-    """If we're logged in, add curr user to Flask global."""
+    """If we're logged in, add curr user to Flask global.
 
-    if CURR_USER_KEY in session:
-        g.user = User.query.get(session[CURR_USER_KEY])
+    `g.user` is a read-only UserSnapshot, served from `user_cache` when
+    possible; views that change the user load the `User` row themselves.
+    """
 
-    else:
+    # connect_db leaves an app context pushed, so `g` can outlive a
+    # request; drop the per-request follow cache used by followed_ids().
+    g.pop('following_ids', None)
+    g.pop('follow_checked_ids', None)
+    g.pop('etag', None)
+
+    user_id = session.get(CURR_USER_KEY)
+
+    if user_id is None:
         g.user = None
+        return
+
+    g.user = user_cache.get(user_id)
+
+    if g.user is None:
+        user = User.visible().filter(User.id == user_id).first()
+        g.user = UserSnapshot.from_user(user) if user else None
+
+        if g.user:
+            user_cache.set(g.user)
+
+
+def followed_ids(users):
+    """Return the ids among `users` that the current user follows.
+
+    Each call resolves only ids not seen yet this request, in one query;
+    answers are kept on `g` so repeated checks during a render are free.
+    """
+
+    if not g.user:
+        return set()
+
+    checked = g.setdefault('follow_checked_ids', set())
+    following = g.setdefault('following_ids', set())
+
+    unchecked = {user.id for user in users} - checked
+    if unchecked:
+        following |= g.user.following_ids_among(unchecked)
+        checked |= unchecked
+
+    return following
+
+
+def stream_page(template, **context):
+    """Render `template` as a streamed response.
+
+    The headers (and session cookie) go out before the body is rendered,
+    so flashed messages are taken off the session first; base.html then
+    reads the copy Flask keeps for the rest of the request.
+    """
+
+    get_flashed_messages(with_categories=True)
+    return app.response_class(stream_template(template, **context))
+
+
+def follows_page(listed, owner, user_id):
+    """One page of the users on the `listed` side of `user_id`'s follows.
+
+    `listed` and `owner` are the two Follows columns, e.g. for "who does
+    user_id follow", user_being_followed_id and user_following_id. Users
+    come newest follow first, paged with a 'before' cursor.
+    """
+
+    page = keyset_page(
+        (db.session.query(User, Follows.created_at)
+         .join(Follows, listed == User.id)
+         .filter(owner == user_id, User.deleted_at.is_(None))),
+        columns=(Follows.created_at, listed),
+        key=lambda row: (row.created_at, row.User.id),
+        before=request.args.get('before'),
+        per_page=USERS_PER_PAGE,
+    )
+    return Page([user for user, _ in page.items], page.next_cursor)
 
 
 def do_login(user):
@@ -81,6 +219,7 @@ def signup():
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        user_cache.invalidate(user.id)
         do_login(user)
 
         return redirect("/")
@@ -100,6 +239,8 @@ def login():
                                  form.password.data)
 
         if user:
+            # saves the password if authenticate rehashed it
+            db.session.commit()
             do_login(user)
             flash(f"Hello, {user.username}!", "success")
             return redirect("/")
@@ -109,6 +250,14 @@ def login():
     return render_template('users/login.html', form=form)
 
 
+@app.errorhandler(PasswordHasherBusy)
+def password_hasher_busy(err):
+    """Too many logins/signups at once: ask the client to retry shortly."""
+
+    return ("Too many people are signing in right now; please try again in a moment.",
+            503, {'Retry-After': '1'})
+
+
 @app.route('/logout')
 def logout():
     """Handle logout of user."""
@@ -124,35 +273,50 @@ def logout():
 # General user routes:
 
 @app.route('/users')
+@read_replica
 def list_users():
     """Page with listing of users.
 
-    Can take a 'q' param in querystring to search by that username.
+    Can take a 'q' param in querystring to search usernames, bios and
+    locations; matches are ranked and paged with a 'page' param. Without
+    'q', lists the newest users first, paged with a 'before' cursor.
     """
 
     search = request.args.get('q')
 
     if not search:
-        users = User.query.all()
+        page = keyset_page(
+            User.visible(),
+            columns=(User.id,),
+            key=lambda user: (user.id,),
+            before=request.args.get('before'),
+            per_page=USERS_PER_PAGE,
+        )
+        users = page.items
+        next_url = (url_for('list_users', before=page.next_cursor)
+                    if page.next_cursor else None)
     else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+        page_number = max(request.args.get('page', 1, type=int), 1)
+        users, has_more = User.search(search, page_number, USERS_PER_PAGE)
+        next_url = (url_for('list_users', q=search, page=page_number + 1)
+                    if has_more else None)
 
-    return render_template('users/index.html', users=users)
+    return stream_page('users/index.html', users=users,
+                       next_url=next_url,
+                       following_ids=followed_ids(users))
 
 
 @app.route('/users/add_like/<int:msg_id>', methods=['POST'])
 def add_like(msg_id):
     """add like to users likes"""
 
-    like = Likes.query.filter(Likes.user_id==g.user.id, Likes.message_id==msg_id).first()
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    if like:
-        db.session.delete(like)
-        db.session.commit()
-    else:
-        like = Likes(user_id= g.user.id, message_id=msg_id) 
-        db.session.add(like)
-        db.session.commit()
+    Likes.toggle(g.user.id, msg_id)
+    db.session.commit()
+    user_cache.invalidate(g.user.id)
 
     return redirect('/')
 
@@ -160,38 +324,85 @@ def add_like(msg_id):
 def remove_like(msg_id, user_id):
     """remove like from users likes"""
 
-    like = Likes.query.filter(Likes.user_id==g.user.id, Likes.message_id==msg_id).first()
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
 
-    db.session.delete(like)
+    Likes.remove(g.user.id, msg_id)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
 
     return redirect(f'/user/{user_id}/likes')
 
 
+@app.route('/messages/<int:message_id>/like', methods=['POST', 'DELETE'])
+def like_message(message_id):
+    """Like (POST) or unlike (DELETE) a message; both are idempotent.
+
+    Returns JSON with the new state and the message's like count, for the
+    like buttons to call without reloading the page.
+    """
+
+    if not g.user:
+        return jsonify(error="login required"), 401
+
+    if request.method == 'POST':
+        Likes.add(g.user.id, message_id)
+    else:
+        Likes.remove(g.user.id, message_id)
+
+    liked, likes = Likes.state(g.user.id, message_id)
+    db.session.commit()
+    user_cache.invalidate(g.user.id)
+
+    if not likes and not db.session.get(Message, message_id):
+        return jsonify(error="no such message"), 404
+
+    return jsonify(message_id=message_id, liked=liked, likes=likes)
+
+
 @app.route('/user/<int:user_id>/likes')
+@read_replica
 def show_likes(user_id):
     """show users liked messages"""
 
-    user = User.query.get_or_404(user_id)
-    messages = (user.likes)
-
-    return render_template('users/likes.html', messages=messages, user=user)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+    page = keyset_page(
+        (Message
+         .query
+         .options(db.joinedload(Message.user))
+         .join(Likes)
+         .filter(Likes.user_id == user_id,
+                 Message.user_id.notin_(User.hidden_ids()))),
+        columns=(Message.timestamp, Message.id),
+        key=lambda msg: (msg.timestamp, msg.id),
+        before=request.args.get('before'),
+    )
+
+    return render_template('users/likes.html', messages=page.items,
+                           next_cursor=page.next_cursor, user=user)
 
 @app.route('/users/<int:user_id>')
+@read_replica
 def users_show(user_id):
     """Show user profile."""
 
-    user = User.query.get_or_404(user_id)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+
+    # the user's version changes with every message they post or delete
+    if response := not_modified(user.id, user.version):
+        return response
 
     # snagging messages in order from the database;
     # user.messages won't be in order by default
-    messages = (Message
-                .query
-                .filter(Message.user_id == user_id)
-                .order_by(Message.timestamp.desc())
-                .limit(100)
-                .all())
-    return render_template('users/show.html', user=user, messages=messages)
+    page = keyset_page(
+        Message.query.filter(Message.user_id == user_id),
+        columns=(Message.timestamp, Message.id),
+        key=lambda msg: (msg.timestamp, msg.id),
+        before=request.args.get('before'),
+    )
+    return render_template('users/show.html', user=user, messages=page.items,
+                           next_cursor=page.next_cursor)
 
 
 @app.route('/users/<int:user_id>/following')
@@ -202,8 +413,16 @@ def show_following(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+    page = follows_page(Follows.user_being_followed_id, Follows.user_following_id, user.id)
+
+    if response := not_modified(user.id, user.version,
+                                [(other.id, other.version) for other in page.items]):
+        return response
+
+    return stream_page('users/following.html', user=user, users=page.items,
+                       next_cursor=page.next_cursor,
+                       following_ids=followed_ids(page.items))
 
 
 @app.route('/users/<int:user_id>/followers')
@@ -214,8 +433,16 @@ def users_followers(user_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.visible().filter(User.id == user_id).first_or_404()
+    page = follows_page(Follows.user_following_id, Follows.user_being_followed_id, user.id)
+
+    if response := not_modified(user.id, user.version,
+                                [(other.id, other.version) for other in page.items]):
+        return response
+
+    return stream_page('users/followers.html', user=user, users=page.items,
+                       next_cursor=page.next_cursor,
+                       following_ids=followed_ids(page.items))
 
 
 @app.route('/users/follow/<int:follow_id>', methods=['POST'])
@@ -226,9 +453,16 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
-    g.user.following.append(followed_user)
+    followed_user = User.visible().filter(User.id == follow_id).first_or_404()
+    db.session.add(Follows(user_being_followed_id=followed_user.id,
+                           user_following_id=g.user.id))
+    db.session.flush()
+    HomeTimeline.backfill(g.user.id, followed_user.id)
+    User.adjust_counts(g.user.id, following_count=1)
+    User.adjust_counts(followed_user.id, followers_count=1)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    user_cache.invalidate(followed_user.id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -241,9 +475,20 @@ def stop_following(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get(follow_id)
-    g.user.following.remove(followed_user)
+    unfollowed = db.session.execute(
+        db.delete(Follows)
+        .where(Follows.user_being_followed_id == follow_id,
+               Follows.user_following_id == g.user.id)
+    ).rowcount
+
+    if unfollowed:
+        HomeTimeline.prune(g.user.id, follow_id)
+        User.adjust_counts(g.user.id, following_count=-1)
+        User.adjust_counts(follow_id, followers_count=-1)
+
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    user_cache.invalidate(follow_id)
 
     return redirect(f"/users/{g.user.id}/following")
 
@@ -259,17 +504,21 @@ def profile():
     form = UserEditForm()
 
     if form.validate_on_submit():
-        
-        g.user.username = form.username.data if form.username.data != '' else g.user.username
-        g.user.email = form.email.data if form.email.data != '' else g.user.email
-        g.user.image_url = form.image_url.data if form.image_url.data != '' else g.user.image_url
-        g.user.header_image_url = form.header_image_url.data if form.header_image_url.data != '' else g.user.header_image_url
-        g.user.bio = form.bio.data if form.bio.data != '' else g.user.bio
-        g.user.location = form.location.data if form.location.data != '' else g.user.location
+        user = User.query.get_or_404(g.user.id)
+
+        user.username = form.username.data if form.username.data != '' else user.username
+        user.email = form.email.data if form.email.data != '' else user.email
+        user.image_url = form.image_url.data if form.image_url.data != '' else user.image_url
+        user.header_image_url = form.header_image_url.data if form.header_image_url.data != '' else user.header_image_url
+        user.bio = form.bio.data if form.bio.data != '' else user.bio
+        user.location = form.location.data if form.location.data != '' else user.location
+        user.bump_version()
 
         db.session.commit()
+        user_cache.invalidate(user.id)
+        fragment_cache.invalidate_author(user.id)
 
-        return redirect(f'/users/{g.user.id}')
+        return redirect(f'/users/{user.id}')
 
     return render_template('users/edit.html', form = form)
 
@@ -287,8 +536,12 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    user = User.query.get_or_404(g.user.id)
+    user.hide()
+    enqueue('delete_user', user_id=user.id)
     db.session.commit()
+    user_cache.invalidate(user.id)
+    fragment_cache.invalidate_author(user.id)
 
     return redirect("/signup")
 
@@ -310,9 +563,13 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        msg = Message(text=form.text.data, user_id=g.user.id)
+        db.session.add(msg)
+        db.session.flush()
+        enqueue('fan_out', message_id=msg.id)
+        User.adjust_counts(g.user.id, messages_count=1)
         db.session.commit()
+        user_cache.invalidate(g.user.id)
 
         return redirect(f"/users/{g.user.id}")
 
@@ -320,10 +577,21 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET"])
+@read_replica
 def messages_show(message_id):
     """Show a message."""
 
-    msg = Message.query.get(message_id)
+    msg = (Message
+           .query
+           .options(db.joinedload(Message.user))
+           .get_or_404(message_id))
+
+    if msg.user.deleted_at:
+        abort(404)
+
+    if response := not_modified(msg.id, msg.user.id, msg.user.version):
+        return response
+
     return render_template('messages/show.html', message=msg)
 
 
@@ -341,51 +609,70 @@ def messages_destroy(message_id):
         return redirect("/")
 
     msg = Message.query.get(message_id)
+    User.adjust_counts(
+        db.select(Likes.user_id).where(Likes.message_id == msg.id),
+        likes_count=-1,
+    )
+    User.adjust_counts(msg.user_id, messages_count=-1)
     db.session.delete(msg)
     db.session.commit()
+    user_cache.invalidate(g.user.id)
+    fragment_cache.invalidate(message_id)
 
     return redirect(f"/users/{g.user.id}")
 
 
+##############################################################################
+# Maintenance commands
+
+
+@app.cli.command('recount-stats')
+def recount_stats():
+    """Recompute every user's message/follow/like counters."""
+
+    User.recount_stats()
+    db.session.commit()
+
+
 ##############################################################################
 # Homepage and error pages
 
 
 @app.route('/')
+@read_replica
 def homepage():
     """Show homepage:
 
     - anon users: no messages
-    - logged in: 100 most recent messages of followed_users
+    - logged in: 100 most recent messages of followed_users, with a
+      `?before=` cursor to page further back
     """
     if g.user:
-        following = [user.id for user in g.user.following]
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-        likes = g.user.likes
-        return render_template('home.html', messages=messages, likes=likes)
+        page = keyset_page(
+            (Message
+             .query
+             .options(db.joinedload(Message.user))
+             .join(HomeTimeline, HomeTimeline.message_id == Message.id)
+             .filter(HomeTimeline.user_id == g.user.id,
+                     HomeTimeline.author_id.notin_(User.hidden_ids()))),
+            columns=(HomeTimeline.timestamp, HomeTimeline.message_id),
+            key=lambda msg: (msg.timestamp, msg.id),
+            before=request.args.get('before'),
+        )
+        likes = g.user.liked_ids_among(msg.id for msg in page.items)
+        return render_template('home.html', messages=page.items,
+                               next_cursor=page.next_cursor, likes=likes)
 
     else:
         return render_template('home-anon.html')
 
 
 ##############################################################################
-# Turn off all caching in Flask
-#   (useful for dev; in production, this kind of stuff is typically
-#   handled elsewhere)
-#
-# https://stackoverflow.com/questions/34066804/disabling-caching-in-flask
+# HTTP caching: pages that call not_modified() are ETagged and revalidated;
+# nothing else may be stored.
 
 @app.after_request
-def add_header(req):
-    """Add non-caching headers on every request."""
-
-    req.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    req.headers["Pragma"] = "no-cache"
-    req.headers["Expires"] = "0"
-    req.headers['Cache-Control'] = 'public, max-age=0'
-    return req
+def add_header(response):
+    """Apply the page's caching policy; see http_cache.py."""
+
+    return apply_cache_policy(response)
@@ -0,0 +1,294 @@
+"""ASGI entry point, with async versions of the read-heavy pages.
+
+    uvicorn asgi:app --workers 4
+
+The homepage and user profiles are served by async views on SQLAlchemy's
+asyncio engine (asyncpg), so one process can have many of them waiting
+on PostgreSQL at once instead of one per thread. Every other URL goes to
+the Flask app, which a2wsgi runs on a thread pool. These two pages go
+there too when the async view can't answer them: a flash is waiting to
+be shown, the user doesn't exist, or the cursor is bad.
+
+Both sides share models.py, the templates, the session cookie, the user
+and fragment caches, the ETags, the metrics and the replica stickiness
+of replicas.py.
+"""
+
+import random
+from contextlib import asynccontextmanager
+from time import perf_counter, time
+from types import SimpleNamespace
+
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy import exists, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import joinedload
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import HTMLResponse, Response
+from starlette.routing import Mount, Route
+from werkzeug.exceptions import HTTPException
+
+from app import app as flask_app, user_cache, CURR_USER_KEY
+from db_pool import TimedAsyncQueuePool, pgbouncer_connect_args
+from http_cache import page_etag
+from metrics import registry, watch_pool
+from models import User, Message, Likes, Follows, HomeTimeline
+from pagination import keyset_page_async
+from replicas import REPLICA_BIND_PREFIX, STICKY_KEY
+from user_cache import UserSnapshot
+
+flask_wsgi = WSGIMiddleware(flask_app)
+
+
+def async_engine(url, label):
+    """Engine on asyncpg for `url`, pooled like the Flask app's engines.
+
+    Its pool is reported in the metrics as "async-`label`".
+    """
+
+    url = make_url(url).set(drivername='postgresql+asyncpg')
+    options = {name: value
+               for name, value in flask_app.config['SQLALCHEMY_ENGINE_OPTIONS'].items()
+               if name != 'connect_args'}
+    options['poolclass'] = TimedAsyncQueuePool
+
+    if flask_app.config['DB_PGBOUNCER']:
+        options['connect_args'] = pgbouncer_connect_args(url)
+
+    engine = create_async_engine(url, **options)
+    watch_pool(f"async-{label}", engine.sync_engine)
+    return engine
+
+
+primary = async_engine(flask_app.config['SQLALCHEMY_DATABASE_URI'], 'primary')
+replicas = [async_engine(url, key)
+            for key, url in flask_app.config['SQLALCHEMY_BINDS'].items()
+            if key.startswith(REPLICA_BIND_PREFIX)]
+
+
+def session_data(request):
+    """The Flask session from the request's cookie, or {}."""
+
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie:
+        return {}
+
+    serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    try:
+        return serializer.loads(
+            cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+async def load_viewer(session, user_id):
+    """Snapshot of the logged-in user, as add_user_to_g loads it."""
+
+    if user_id is None:
+        return None
+
+    # the shared cache is a blocking socket round trip
+    snapshot = await run_in_threadpool(user_cache.get, user_id)
+    if snapshot is None:
+        user = await session.get(User, user_id)
+        if user is None or user.deleted_at:
+            return None
+
+        snapshot = UserSnapshot.from_user(user)
+        await run_in_threadpool(user_cache.set, snapshot)
+
+    return snapshot
+
+
+class Viewer:
+    """`g.user` for async pages, with follow state loaded up front.
+
+    Templates call g.user.is_following(user), which would otherwise run
+    a blocking query in the middle of rendering.
+    """
+
+    def __init__(self, snapshot, following_ids=()):
+        self._snapshot = snapshot
+        self._following_ids = set(following_ids)
+
+    def __getattr__(self, name):
+        return getattr(self._snapshot, name)
+
+    def is_following(self, other_user):
+        return other_user.id in self._following_ids
+
+
+def render(template, endpoint, viewer, **context):
+    """Render `template` without a Flask request, as render_template would."""
+
+    return flask_app.jinja_env.get_template(template).render(
+        g=SimpleNamespace(user=viewer),
+        request=SimpleNamespace(endpoint=endpoint),
+        get_flashed_messages=lambda **kwargs: [],
+        **context,
+    )
+
+
+def page_tag(request, viewer, *parts):
+    """The ETag http_cache.not_modified would give this page."""
+
+    full_path = f"{request.url.path}?{request.scope['query_string'].decode()}"
+    return page_etag(flask_app.config['ETAG_VERSION'], full_path,
+                     (viewer.id, viewer.version) if viewer else None, *parts)
+
+
+def client_has(request, etag):
+    tags = [tag.strip().removeprefix('W/').strip('"')
+            for tag in request.headers.get('if-none-match', '').split(',')]
+    return etag in tags or '*' in tags
+
+
+def page_response(html=None, etag=None, viewer=None):
+    """200 (or 304, without `html`) with http_cache's caching policy."""
+
+    headers = {'Vary': 'Cookie'}
+
+    if etag:
+        headers['ETag'] = f'"{etag}"'
+        headers['Cache-Control'] = f"no-cache, {'private' if viewer else 'public'}"
+    else:
+        headers['Cache-Control'] = 'no-store'
+
+    if html is None:
+        return Response(status_code=304, headers=headers)
+
+    return HTMLResponse(html, headers=headers)
+
+
+class AsyncPage:
+    """ASGI app running `view(request, session, viewer)` for one page.
+
+    The view returns a response, or None to hand the request to Flask.
+    """
+
+    def __init__(self, endpoint, view):
+        self.endpoint = endpoint
+        self.view = view
+
+    async def __call__(self, scope, receive, send):
+        start = perf_counter()
+        request = Request(scope, receive)
+
+        response = await self.respond(request)
+        if response is None:
+            await flask_wsgi(scope, receive, send)
+            return
+
+        registry.inc('warbler_requests_total', {
+            'endpoint': self.endpoint,
+            'method': request.method,
+            'status': response.status_code,
+        })
+        registry.observe('warbler_request_duration_seconds',
+                         {'endpoint': self.endpoint}, perf_counter() - start)
+
+        await response(scope, receive, send)
+
+    async def respond(self, request):
+        data = session_data(request)
+
+        # flashes are taken off the session, which only Flask writes back
+        if data.get('_flashes'):
+            return None
+
+        engine = primary
+        if replicas and data.get(STICKY_KEY, 0) <= time():
+            engine = random.choice(replicas)
+
+        async with AsyncSession(engine) as session:
+            viewer = await load_viewer(session, data.get(CURR_USER_KEY))
+            try:
+                return await self.view(request, session, viewer)
+            except HTTPException:
+                return None
+
+
+async def homepage(request, session, viewer):
+    """Async homepage(); see app.py."""
+
+    if viewer is None:
+        return page_response(render('home-anon.html', 'homepage', None))
+
+    page = await keyset_page_async(
+        session,
+        (select(Message)
+         .options(joinedload(Message.user))
+         .join(HomeTimeline, HomeTimeline.message_id == Message.id)
+         .where(HomeTimeline.user_id == viewer.id,
+                HomeTimeline.author_id.notin_(User.hidden_ids()))),
+        columns=(HomeTimeline.timestamp, HomeTimeline.message_id),
+        key=lambda msg: (msg.timestamp, msg.id),
+        before=request.query_params.get('before'),
+    )
+
+    likes = set()
+    if page.items:
+        likes = set(await session.scalars(
+            select(Likes.message_id)
+            .where(Likes.user_id == viewer.id,
+                   Likes.message_id.in_([msg.id for msg in page.items]))))
+
+    return page_response(render('home.html', 'homepage', Viewer(viewer),
+                                messages=page.items,
+                                next_cursor=page.next_cursor, likes=likes))
+
+
+async def users_show(request, session, viewer):
+    """Async users_show(); see app.py."""
+
+    user = await session.get(User, request.path_params['user_id'])
+    if user is None or user.deleted_at:
+        return None
+
+    etag = page_tag(request, viewer, user.id, user.version)
+    if client_has(request, etag):
+        return page_response(etag=etag, viewer=viewer)
+
+    page = await keyset_page_async(
+        session,
+        (select(Message)
+         .options(joinedload(Message.user))
+         .where(Message.user_id == user.id)),
+        columns=(Message.timestamp, Message.id),
+        key=lambda msg: (msg.timestamp, msg.id),
+        before=request.query_params.get('before'),
+    )
+
+    following_ids = ()
+    if viewer and viewer.id != user.id and await session.scalar(
+            select(exists().where(Follows.user_following_id == viewer.id,
+                                  Follows.user_being_followed_id == user.id))):
+        following_ids = (user.id,)
+
+    html = render('users/show.html', 'users_show',
+                  viewer and Viewer(viewer, following_ids),
+                  user=user, messages=page.items, next_cursor=page.next_cursor)
+    return page_response(html, etag=etag, viewer=viewer)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+
+    for engine in [primary, *replicas]:
+        await engine.dispose()
+
+
+app = Starlette(
+    routes=[
+        Route('/', AsyncPage('homepage', homepage), methods=['GET', 'HEAD']),
+        Route('/users/{user_id:int}', AsyncPage('users_show', users_show),
+              methods=['GET', 'HEAD']),
+        Mount('/', flask_wsgi),
+    ],
+    lifespan=lifespan,
+)
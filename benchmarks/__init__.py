@@ -0,0 +1,17 @@
+"""Load-test and benchmark suite for Warbler.
+
+Build a dataset, start the app and a jobs worker against it, then drive
+it:
+
+    DATABASE_URL=postgresql:///warbler-bench python -m benchmarks.dataset --users 10000
+    DATABASE_URL=postgresql:///warbler-bench flask run
+    DATABASE_URL=postgresql:///warbler-bench flask jobs work
+    python -m benchmarks.run --base-url http://localhost:5000 --output results.json
+
+Without the worker, posts never reach followers' home timelines and the
+homepage route measures stale timelines.
+
+Compare two releases with:
+
+    python -m benchmarks.compare old.json new.json
+"""
@@ -0,0 +1,41 @@
+"""Compare two benchmark result files route by route.
+
+    python -m benchmarks.compare baseline.json candidate.json
+"""
+
+import argparse
+import json
+
+METRICS = ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms')
+
+
+def change(old, new):
+    if old in (None, 0) or new is None:
+        return '     n/a'
+    return f"{(new - old) / old * 100:+7.1f}%"
+
+
+def compare(baseline, candidate):
+    print(f"baseline:  {baseline.get('revision')}  ({baseline['started_at']})")
+    print(f"candidate: {candidate.get('revision')}  ({candidate['started_at']})")
+    print()
+    print(f"{'route':>10}  " + "  ".join(f"{metric:>22}" for metric in METRICS))
+
+    for route in sorted(set(baseline['routes']) | set(candidate['routes'])):
+        old = baseline['routes'].get(route, {})
+        new = candidate['routes'].get(route, {})
+        cells = (
+            f"{new.get(metric)!s:>12} {change(old.get(metric), new.get(metric))}"
+            for metric in METRICS
+        )
+        print(f"{route:>10}  " + "  ".join(cells))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args()
+
+    with open(args.baseline) as old, open(args.candidate) as new:
+        compare(json.load(old), json.load(new))
@@ -0,0 +1,192 @@
+"""Build a synthetic benchmark dataset in DATABASE_URL.
+
+Follows and message authorship are power-law distributed, so a handful
+of celebrity accounts have a large share of all followers, like a real
+social graph. Everything is generated in chunks and inserted with
+executemany, so memory stays flat whatever the scale.
+
+    python -m benchmarks.dataset --users 1000000 --messages 10000000
+
+THIS DROPS AND RECREATES EVERY TABLE in the target database.
+"""
+
+import argparse
+import itertools
+import json
+import random
+from datetime import datetime, timedelta
+
+from flask_bcrypt import generate_password_hash
+
+WORDS = (
+    "the quick brown fox jumps over lazy dog warble tweet bird song sky "
+    "morning coffee code ship deploy test cache query index fast slow "
+    "today tomorrow love hate new old big small friend hello world"
+).split()
+
+BENCH_PASSWORD = "password"
+
+CHUNK_SIZE = 10_000
+
+# Bench users whose home timelines are rebuilt per transaction.
+TIMELINE_BATCH_SIZE = 50
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=10_000)
+    parser.add_argument('--messages', type=int, default=100_000)
+    parser.add_argument('--follows-per-user', type=float, default=50,
+                        help="mean number of accounts each user follows")
+    parser.add_argument('--celebrities', type=int, default=10,
+                        help="accounts that a large share of users follow")
+    parser.add_argument('--celebrity-share', type=float, default=0.3,
+                        help="chance each user follows each celebrity")
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help="power-law exponent for followers and authorship")
+    parser.add_argument('--likes-per-user', type=float, default=10)
+    parser.add_argument('--bench-users', type=int, default=200,
+                        help="users the load driver logs in as")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bcrypt-rounds', type=int, default=4,
+                        help="cost of the shared bench password hash")
+    parser.add_argument('--manifest', default='benchmarks/dataset.json',
+                        help="where to write what the load driver needs")
+    return parser.parse_args(argv)
+
+
+def power_law_sampler(n, exponent, rng):
+    """Return a function picking ids 1..n with P(id=k) ~ 1 / k**exponent.
+
+    Inverts the CDF of the continuous power law, so it needs no
+    per-id table even for tens of millions of ids.
+    """
+
+    if abs(exponent - 1) < 1e-9:
+        return lambda: min(int((n + 1) ** rng.random()), n)
+
+    power = 1 - exponent
+    top = (n + 1) ** power
+
+    def sample():
+        return min(int((1 + (top - 1) * rng.random()) ** (1 / power)), n)
+
+    return sample
+
+
+def chunked(rows, size=CHUNK_SIZE):
+    iterator = iter(rows)
+    while chunk := list(itertools.islice(iterator, size)):
+        yield chunk
+
+
+def generate_users(args, password):
+    for i in range(1, args.users + 1):
+        yield {
+            'email': f"user{i}@bench.warbler",
+            'username': f"user{i}",
+            'image_url': "/static/images/default-pic.png",
+            'header_image_url': "/static/images/warbler-hero.jpg",
+            'password': password,
+            'bio': f"Benchmark account {i}",
+            'location': "Benchville",
+        }
+
+
+def generate_messages(args, rng):
+    author = power_law_sampler(args.users, args.zipf, rng)
+    now = datetime.utcnow()
+
+    for _ in range(args.messages):
+        yield {
+            'text': " ".join(rng.choices(WORDS, k=rng.randint(3, 20)))[:140],
+            'timestamp': now - timedelta(seconds=rng.randint(0, 365 * 86400)),
+            'user_id': author(),
+        }
+
+
+def generate_follows(args, rng):
+    followed = power_law_sampler(args.users, args.zipf, rng)
+    celebrities = range(1, min(args.celebrities, args.users) + 1)
+
+    for follower in range(1, args.users + 1):
+        targets = {celebrity for celebrity in celebrities
+                   if rng.random() < args.celebrity_share}
+
+        wanted = min(int(rng.expovariate(1 / args.follows_per_user)),
+                     args.users - 1)
+        for _ in range(wanted * 2):
+            if len(targets) >= wanted:
+                break
+            targets.add(followed())
+
+        targets.discard(follower)
+        for target in targets:
+            yield {'user_being_followed_id': target,
+                   'user_following_id': follower}
+
+
+def generate_likes(args, rng):
+    message = power_law_sampler(args.messages, args.zipf, rng)
+
+    for user_id in range(1, args.users + 1):
+        liked = {message()
+                 for _ in range(int(rng.expovariate(1 / args.likes_per_user)))}
+        for message_id in liked:
+            yield {'user_id': user_id, 'message_id': message_id}
+
+
+def insert(db, model, rows):
+    count = 0
+    for chunk in chunked(rows):
+        db.session.execute(db.insert(model), chunk)
+        db.session.commit()
+        count += len(chunk)
+    print(f"  {model.__tablename__}: {count} rows")
+
+
+def build(args):
+    import migrations
+    from app import app, db
+    from models import User, Message, Follows, Likes, HomeTimeline
+
+    rng = random.Random(args.seed)
+    password = generate_password_hash(
+        BENCH_PASSWORD, args.bcrypt_rounds).decode('UTF-8')
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        migrations.stamp()
+
+        insert(db, User, generate_users(args, password))
+        insert(db, Message, generate_messages(args, rng))
+        insert(db, Follows, generate_follows(args, rng))
+        insert(db, Likes, generate_likes(args, rng))
+
+        bench_users = rng.sample(range(1, args.users + 1),
+                                 min(args.bench_users, args.users))
+        User.recount_stats()
+        db.session.commit()
+
+        # capped per author like backfill, so timelines match production's
+        for user_ids in chunked(bench_users, TIMELINE_BATCH_SIZE):
+            HomeTimeline.rebuild(user_ids)
+            db.session.commit()
+
+    manifest = {
+        'users': args.users,
+        'messages': args.messages,
+        'celebrities': args.celebrities,
+        'password': BENCH_PASSWORD,
+        'bench_users': [f"user{i}" for i in bench_users],
+        'args': vars(args),
+    }
+    with open(args.manifest, 'w') as out:
+        json.dump(manifest, out, indent=2)
+
+    print(f"wrote {args.manifest}")
+
+
+if __name__ == '__main__':
+    build(parse_args())
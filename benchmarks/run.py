@@ -0,0 +1,265 @@
+"""Drive a running Warbler concurrently and report per-route latency.
+
+Each worker thread logs in as one of the dataset's bench users and then
+picks routes at random, weighted by --mix, until --duration runs out.
+Results (throughput and p50/p95/p99 latency per route) are written as
+JSON to --output.
+
+    python -m benchmarks.run --base-url http://localhost:5000 \\
+        --concurrency 32 --duration 60 --output results.json
+"""
+
+import argparse
+import json
+import platform
+import random
+import re
+import subprocess
+import threading
+import time
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import (HTTPCookieProcessor, HTTPRedirectHandler,
+                            Request, build_opener)
+
+DEFAULT_MIX = "homepage=40,profile=25,search=15,like=15,post=5"
+
+CSRF_RE = re.compile(r'name="csrf_token" type="hidden" value="([^"]+)"')
+
+
+class NoRedirect(HTTPRedirectHandler):
+    """Report redirects as responses; writes are timed without the follow-up page."""
+
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class Client:
+    """One logged-in browser session against the app."""
+
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = build_opener(HTTPCookieProcessor(CookieJar()), NoRedirect)
+        # messages this session has liked, so `like` can toggle them back
+        self.liked = set()
+
+    def request(self, path, data=None, method=None):
+        """Fetch `path`, returning (status, body); POSTs when `data` is given."""
+
+        body = urlencode(data).encode() if data is not None else None
+        try:
+            with self.opener.open(Request(self.base_url + path, body, method=method),
+                                  timeout=self.timeout) as resp:
+                return resp.status, resp.read().decode()
+        except HTTPError as err:
+            return err.code, err.read().decode(errors='replace')
+
+    def csrf_token(self, path):
+        match = CSRF_RE.search(self.request(path)[1])
+        return match.group(1) if match else ''
+
+    def login(self, username, password):
+        status, _ = self.request('/login', {
+            'csrf_token': self.csrf_token('/login'),
+            'username': username,
+            'password': password,
+        })
+        if status != 302:
+            raise RuntimeError(f"could not log in as {username} ({status})")
+
+
+def build_routes(manifest, rng):
+    """Map route name -> function(client) preparing one request.
+
+    Each function does any untimed setup (e.g. fetching a CSRF token)
+    and returns a callable that makes the timed request.
+    """
+
+    users = manifest['users']
+    messages = manifest['messages']
+
+    def homepage(client):
+        return lambda: client.request('/')
+
+    def profile(client):
+        return lambda: client.request(f'/users/{rng.randint(1, users)}')
+
+    def search(client):
+        prefix = f"user{rng.randint(1, users)}"[:rng.randint(5, 7)]
+        return lambda: client.request('/users?' + urlencode({'q': prefix}))
+
+    def like(client):
+        # alternate like and unlike per message, so both paths (and the
+        # counter updates) are timed rather than repeated no-op likes
+        message_id = rng.randint(1, messages)
+        path = f'/messages/{message_id}/like'
+
+        if message_id in client.liked:
+            client.liked.discard(message_id)
+            return lambda: client.request(path, method='DELETE')
+
+        client.liked.add(message_id)
+        return lambda: client.request(path, {})
+
+    def post(client):
+        token = client.csrf_token('/messages/new')
+        return lambda: client.request('/messages/new', {
+            'csrf_token': token,
+            'text': f"benchmark warble {rng.random()}",
+        })
+
+    return {'homepage': homepage, 'profile': profile, 'search': search,
+            'like': like, 'post': post}
+
+
+def parse_mix(mix):
+    weights = {}
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))),
+                len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def worker(args, manifest, username, routes, weights, measure_from, deadline,
+           results, lock):
+    rng = random.Random()
+    client = Client(args.base_url, args.timeout)
+    client.login(username, manifest['password'])
+
+    names = list(weights)
+    latencies = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+
+    while time.perf_counter() < deadline:
+        name = rng.choices(names, weights=[weights[n] for n in names])[0]
+        timed = routes[name](client)
+
+        start = time.perf_counter()
+        try:
+            status, _ = timed()
+        except OSError:
+            status = None
+        elapsed = time.perf_counter() - start
+
+        if start < measure_from:
+            continue
+
+        if status is None or status >= 400:
+            errors[name] += 1
+        else:
+            latencies[name].append(elapsed)
+
+    with lock:
+        for name in names:
+            results[name]['latencies'].extend(latencies[name])
+            results[name]['errors'] += errors[name]
+
+
+def to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+def summarize(results, duration):
+    summary = {}
+    for name, data in results.items():
+        values = sorted(data['latencies'])
+        summary[name] = {
+            'requests': len(values),
+            'errors': data['errors'],
+            'throughput_rps': round(len(values) / duration, 2),
+            'mean_ms': to_ms(sum(values) / len(values)) if values else None,
+            'p50_ms': to_ms(percentile(values, 0.50)),
+            'p95_ms': to_ms(percentile(values, 0.95)),
+            'p99_ms': to_ms(percentile(values, 0.99)),
+            'max_ms': to_ms(values[-1]) if values else None,
+        }
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+
+    weights = parse_mix(args.mix)
+    routes = build_routes(manifest, random.Random(args.seed))
+    unknown = set(weights) - set(routes)
+    if unknown:
+        raise SystemExit(f"unknown routes in --mix: {', '.join(sorted(unknown))}")
+
+    results = {name: {'latencies': [], 'errors': 0} for name in weights}
+    lock = threading.Lock()
+    bench_users = manifest['bench_users']
+
+    measure_from = time.perf_counter() + args.warmup
+    deadline = measure_from + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(
+            args, manifest, bench_users[i % len(bench_users)], routes,
+            weights, measure_from, deadline, results, lock))
+        for i in range(args.concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    report = {
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'duration_s': args.duration,
+        'mix': weights,
+        'dataset': {key: manifest[key]
+                    for key in ('users', 'messages', 'celebrities')},
+        'routes': summarize(results, args.duration),
+    }
+
+    with open(args.output, 'w') as out:
+        json.dump(report, out, indent=2)
+
+    for name, stats in report['routes'].items():
+        print(f"{name:>10}: {stats['throughput_rps']:>8} req/s  "
+              f"p50 {stats['p50_ms']} ms  p95 {stats['p95_ms']} ms  "
+              f"p99 {stats['p99_ms']} ms  errors {stats['errors']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--manifest', default='benchmarks/dataset.json')
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=30,
+                        help="seconds to measure for")
+    parser.add_argument('--warmup', type=float, default=5,
+                        help="seconds to run before measuring")
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help="route weights, e.g. homepage=40,profile=25")
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--seed', type=int, default=None)
+    return parser.parse_args(argv)
+
+
+if __name__ == '__main__':
+    run(parse_args())
@@ -0,0 +1,81 @@
+"""Database connection pool settings and instrumentation.
+
+Every engine (the primary and each replica) gets a QueuePool of
+DB_POOL_SIZE connections plus up to DB_MAX_OVERFLOW more under load;
+a request waits at most DB_POOL_TIMEOUT seconds for one. Connections
+are replaced after DB_POOL_RECYCLE seconds and, with DB_POOL_PRE_PING,
+tested before use, so a failover costs a reconnect instead of an error.
+
+Set DB_PGBOUNCER=1 when DATABASE_URL points at PgBouncer in transaction
+pooling mode. Consecutive transactions may then land on different
+server connections, so nothing may be prepared server-side: psycopg2
+never does, and drivers that do (asyncpg) get their statement caches
+turned off. Run `flask migrate` against PostgreSQL directly, as it
+holds a session-level advisory lock.
+"""
+
+from time import perf_counter
+
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from metrics import registry
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool recording how long each checkout waits.
+
+    `metrics_label` names the pool in metrics; init_metrics sets it to
+    the engine's bind key.
+    """
+
+    metrics_label = 'unknown'
+
+    def connect(self):
+        start = perf_counter()
+        try:
+            return super().connect()
+        except TimeoutError:
+            registry.inc('warbler_db_pool_timeouts_total',
+                         {'pool': self.metrics_label})
+            raise
+        finally:
+            registry.observe('warbler_db_pool_wait_seconds',
+                             {'pool': self.metrics_label},
+                             perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics_label = self.metrics_label
+        return pool
+
+
+class TimedAsyncQueuePool(TimedQueuePool, AsyncAdaptedQueuePool):
+    """TimedQueuePool for asyncio engines (asgi.py)."""
+
+
+def engine_options(url, pool_size=5, max_overflow=10, timeout=30, recycle=1800,
+                   pre_ping=True, pgbouncer=False):
+    """SQLALCHEMY_ENGINE_OPTIONS for engines on `url`'s driver."""
+
+    options = {
+        'poolclass': TimedQueuePool,
+        'pool_size': pool_size,
+        'max_overflow': max_overflow,
+        'pool_timeout': timeout,
+        'pool_recycle': recycle,
+        'pool_pre_ping': pre_ping,
+    }
+    if pgbouncer:
+        options['connect_args'] = pgbouncer_connect_args(url)
+    return options
+
+
+def pgbouncer_connect_args(url):
+    """connect_args keeping the driver for `url` from preparing statements."""
+
+    if make_url(url).get_driver_name() == 'asyncpg':
+        return {'statement_cache_size': 0, 'prepared_statement_cache_size': 0}
+
+    return {}
@@ -0,0 +1,86 @@
+"""Cache of rendered message cards.
+
+A card (avatar, author, date and text) looks the same to every viewer,
+so it is rendered once and reused until the message is deleted, its
+author's username or picture changes or the card template itself
+changes. The author's version isn't part of the key: counters bump it
+on every post, like and follow, which would keep busy authors' cards
+from ever staying cached. Buttons that depend on the viewer, like the
+like button, stay in the page template around the cached card.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from markupsafe import Markup
+
+CARD_TEMPLATE = 'messages/_card.html'
+
+
+class FragmentCache:
+    """In-process LRU cache of rendered message cards; size 0 disables it."""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._by_author = {}
+        self._template_versions = {}
+
+    def template_version(self, env, name):
+        """Hash of the template's source, so edited templates miss."""
+
+        version = self._template_versions.get(name)
+        if version is None or env.auto_reload:
+            source = env.loader.get_source(env, name)[0]
+            version = hashlib.sha1(source.encode()).hexdigest()[:12]
+            self._template_versions[name] = version
+        return version
+
+    def render_card(self, env, msg):
+        """Return the card markup for `msg`, rendering it on a miss."""
+
+        stamp = (msg.user.username, msg.user.image_url,
+                 self.template_version(env, CARD_TEMPLATE))
+
+        with self._lock:
+            entry = self._entries.get(msg.id)
+            if entry and entry[0] == stamp:
+                self._entries.move_to_end(msg.id)
+                return entry[1]
+
+        html = Markup(env.get_template(CARD_TEMPLATE).render(msg=msg))
+
+        if self.maxsize > 0:
+            with self._lock:
+                self._entries[msg.id] = (stamp, html, msg.user_id)
+                self._entries.move_to_end(msg.id)
+                self._by_author.setdefault(msg.user_id, set()).add(msg.id)
+
+                while len(self._entries) > self.maxsize:
+                    self._forget(*self._entries.popitem(last=False))
+
+        return html
+
+    def invalidate(self, message_id):
+        """Drop the cached card of a (deleted) message."""
+
+        with self._lock:
+            entry = self._entries.pop(message_id, None)
+            if entry:
+                self._forget(message_id, entry)
+
+    def invalidate_author(self, user_id):
+        """Drop every cached card by `user_id`, e.g. after a profile edit."""
+
+        with self._lock:
+            for message_id in self._by_author.pop(user_id, ()):
+                self._entries.pop(message_id, None)
+
+    def _forget(self, message_id, entry):
+        cards = self._by_author.get(entry[2])
+        if cards is not None:
+            cards.discard(message_id)
+            if not cards:
+                del self._by_author[entry[2]]
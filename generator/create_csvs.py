@@ -3,12 +3,30 @@
 Students won't need to run this for the exercise; they will just use the CSV
 files that this generates. You should only need to run this if you wanted to
 tweak the CSV formats or generate fewer/more rows.
+
+    python generator/create_csvs.py
+    python generator/create_csvs.py --users 1000000 --messages 10000000 \\
+        --follows 50000000 --workers 8
+
+Rows are generated in parallel shards of at most --shard-size rows. A
+table that fits in one shard is written as e.g. users.csv; larger ones
+as users-00000.csv, users-00001.csv, ... which must be loaded in name
+order (seed.py does), since user ids are implied by row order.
+
+Output only depends on the counts, --shard-size and --seed (apart from
+timestamps, which are relative to today), not on --workers. Header
+images come from the bundled header_images.txt unless
+--fetch-header-images is given.
 """
 
+import argparse
 import csv
-from random import choice, randint, sample
-from itertools import permutations
-import requests
+import os
+import random
+from datetime import datetime
+from glob import glob
+from multiprocessing import Pool
+
 from faker import Faker
 from helpers import get_random_datetime
 
@@ -22,9 +40,13 @@ NUM_USERS = 300
 NUM_MESSAGES = 1000
 NUM_FOLLWERS = 5000
 
-fake = Faker()
+SHARD_SIZE = 1_000_000
 
-# Generate random profile image URLs to use for users
+PASSWORD = '$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe'
+
+HEADER_IMAGES_FILE = os.path.join(os.path.dirname(__file__), 'header_images.txt')
+
+# Random profile image URLs to use for users
 
 image_urls = [
     f"https://randomuser.me/api/portraits/{kind}/{i}.jpg"
@@ -32,46 +54,200 @@ image_urls = [
     for i in range(count)
 ]
 
-# Generate random header image URLs to use for users
 
-header_image_urls = [
-    requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
-    for i in range(1, 46)
-]
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=NUM_USERS)
+    parser.add_argument('--messages', type=int, default=NUM_MESSAGES)
+    parser.add_argument('--follows', type=int, default=NUM_FOLLWERS)
+    parser.add_argument('--seed', type=int, default=None,
+                        help="make the output reproducible")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help="processes generating shards in parallel")
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE,
+                        help="maximum rows per CSV file")
+    parser.add_argument('--out-dir', default='generator')
+    parser.add_argument('--fetch-header-images', action='store_true',
+                        help="fetch header image URLs from splashbase "
+                             "instead of using the bundled list")
+    args = parser.parse_args(argv)
+
+    if args.seed is None:
+        args.seed = random.randrange(2 ** 32)
+
+    max_follows = args.users * (args.users - 1)
+    if args.follows > max_follows:
+        parser.error(f"--follows can be at most {max_follows} for {args.users} users")
+
+    return args
+
+
+def load_header_image_urls(fetch):
+    """Header image URLs from the bundled list, or from splashbase."""
+
+    if fetch:
+        import requests
+
+        return [
+            requests.get(f"http://www.splashbase.co/api/v1/images/{i}").json()['url']
+            for i in range(1, 46)
+        ]
+
+    with open(HEADER_IMAGES_FILE) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def split(total, shard_size):
+    """Split range(total) into (start, stop) runs of at most `shard_size`."""
+
+    return [(start, min(start + shard_size, total))
+            for start in range(0, total, shard_size)]
+
+
+def shard_path(out_dir, name, shard, shards):
+    if shards == 1:
+        return os.path.join(out_dir, f'{name}.csv')
+
+    return os.path.join(out_dir, f'{name}-{shard:05d}.csv')
+
+
+def shard_rng(seed, name, shard):
+    """Generators for one shard, independent of which process runs it."""
+
+    key = f"{seed}-{name}-{shard}"
+    fake = Faker()
+    fake.seed_instance(key)
+
+    return random.Random(key), fake
+
+
+def write_users(path, seed, shard, start, stop, header_image_urls):
+    rng, fake = shard_rng(seed, 'users', shard)
+
+    with open(path, 'w', newline='') as users_csv:
+        users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
+        users_writer.writeheader()
+
+        # user ids are 1-based row numbers; suffixing them keeps the
+        # unique columns unique however many users are generated
+        for user_id in range(start + 1, stop + 1):
+            users_writer.writerow(dict(
+                email=f"{fake.user_name()}{user_id}@{fake.free_email_domain()}",
+                username=f"{fake.user_name()}{user_id}",
+                image_url=rng.choice(image_urls),
+                password=PASSWORD,
+                bio=fake.sentence(),
+                header_image_url=rng.choice(header_image_urls),
+                location=fake.city()
+            ))
+
+
+def write_messages(path, seed, shard, start, stop, num_users, now):
+    rng, fake = shard_rng(seed, 'messages', shard)
+
+    with open(path, 'w', newline='') as messages_csv:
+        messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
+        messages_writer.writeheader()
+
+        for _ in range(start, stop):
+            messages_writer.writerow(dict(
+                text=fake.paragraph()[:MAX_WARBLER_LENGTH],
+                timestamp=get_random_datetime(rng=rng, now=now),
+                user_id=rng.randint(1, num_users)
+            ))
+
+
+def write_follows(path, seed, shard, start, stop, num_users, count):
+    """Write `count` distinct random follows by users start+1..stop.
+
+    Each (follower, followed) pair in the shard is numbered, and a
+    sample of those numbers is decoded back into pairs, so memory is
+    proportional to `count` rather than to the number of possible pairs.
+    """
+
+    rng, _ = shard_rng(seed, 'follows', shard)
+    others = num_users - 1
+
+    with open(path, 'w', newline='') as follows_csv:
+        follows_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
+        follows_writer.writeheader()
+
+        for pair in rng.sample(range((stop - start) * others), count):
+            follower = start + 1 + pair // others
+            followed = pair % others + 1
+            if followed >= follower:
+                followed += 1
+
+            follows_writer.writerow(dict(user_being_followed_id=followed, user_following_id=follower))
+
+
+def follow_shards(num_users, num_follows, shard_size):
+    """Split follows into shards by follower, as (start, stop, count).
+
+    Each shard gets a share of the follows proportional to the number of
+    pairs its followers make up, so together they sample pairs uniformly.
+    """
+
+    if not num_follows:
+        return []
+
+    shards = -(-num_follows // shard_size)
+    runs = split(num_users, -(-num_users // shards))
+
+    counts = [num_follows * (stop - start) // num_users for start, stop in runs]
+    for i in range(num_follows - sum(counts)):
+        counts[i] += 1
+
+    return [(start, stop, count)
+            for (start, stop), count in zip(runs, counts)]
+
+
+def clear_old_shards(out_dir, name):
+    """Remove CSVs from a previous run so no stale shard gets loaded."""
+
+    for path in glob(os.path.join(out_dir, f'{name}.csv')) + \
+            glob(os.path.join(out_dir, f'{name}-*.csv')):
+        os.remove(path)
+
+
+def run_task(task):
+    func, *args = task
+    func(*args)
+    return args[0]
+
+
+def main(args):
+    header_image_urls = load_header_image_urls(args.fetch_header_images)
+    now = datetime.now()
+    tasks = []
+
+    runs = split(args.users, args.shard_size)
+    for shard, (start, stop) in enumerate(runs):
+        path = shard_path(args.out_dir, 'users', shard, len(runs))
+        tasks.append((write_users, path, args.seed, shard, start, stop,
+                      header_image_urls))
+
+    runs = split(args.messages, args.shard_size)
+    for shard, (start, stop) in enumerate(runs):
+        path = shard_path(args.out_dir, 'messages', shard, len(runs))
+        tasks.append((write_messages, path, args.seed, shard, start, stop,
+                      args.users, now))
+
+    runs = follow_shards(args.users, args.follows, args.shard_size)
+    for shard, (start, stop, count) in enumerate(runs):
+        path = shard_path(args.out_dir, 'follows', shard, len(runs))
+        tasks.append((write_follows, path, args.seed, shard, start, stop,
+                      args.users, count))
+
+    for name in ('users', 'messages', 'follows'):
+        clear_old_shards(args.out_dir, name)
+
+    with Pool(max(1, args.workers)) as pool:
+        for path in pool.imap_unordered(run_task, tasks):
+            print(f"wrote {path}")
+
+    print(f"seed {args.seed}")
+
 
-with open('generator/users.csv', 'w') as users_csv:
-    users_writer = csv.DictWriter(users_csv, fieldnames=USERS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for i in range(NUM_USERS):
-        users_writer.writerow(dict(
-            email=fake.email(),
-            username=fake.user_name(),
-            image_url=choice(image_urls),
-            password='$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe',
-            bio=fake.sentence(),
-            header_image_url=choice(header_image_urls),
-            location=fake.city()
-        ))
-
-with open('generator/messages.csv', 'w') as messages_csv:
-    messages_writer = csv.DictWriter(messages_csv, fieldnames=MESSAGES_CSV_HEADERS)
-    messages_writer.writeheader()
-
-    for i in range(NUM_MESSAGES):
-        messages_writer.writerow(dict(
-            text=fake.paragraph()[:MAX_WARBLER_LENGTH],
-            timestamp=get_random_datetime(),
-            user_id=randint(1, NUM_USERS)
-        ))
-
-# Generate follows.csv from random pairings of users
-
-with open('generator/follows.csv', 'w') as follows_csv:
-    all_pairs = list(permutations(range(1, NUM_USERS + 1), 2))
-
-    users_writer = csv.DictWriter(follows_csv, fieldnames=FOLLOWS_CSV_HEADERS)
-    users_writer.writeheader()
-
-    for followed_user, follower in sample(all_pairs, NUM_FOLLWERS):
-        users_writer.writerow(dict(user_being_followed_id=followed_user, user_following_id=follower))
+if __name__ == '__main__':
+    main(parse_args())
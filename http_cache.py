@@ -0,0 +1,67 @@
+"""Conditional GET: strong ETags built from row versions.
+
+A view that opts in loads just the rows its page depends on, then calls
+`not_modified(...)` with their versions before doing anything else:
+
+    user = User.query.get_or_404(user_id)
+    if response := not_modified(user.id, user.version):
+        return response
+
+If the client already holds that version of the page it gets an empty
+304; otherwise the view renders as usual and `apply_cache_policy` adds
+the ETag. The viewer, the URL and ETAG_VERSION (bump it when templates
+change) are always part of the tag.
+"""
+
+import hashlib
+
+from flask import Response, current_app, g, request, session
+
+
+def page_etag(*parts):
+    """Hash `parts` into an ETag value."""
+
+    key = "\x1f".join(str(part) for part in parts)
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+def not_modified(*parts):
+    """Return a 304 response if the client's copy is current, else None."""
+
+    # pending flashes get rendered (and consumed) by the page, so it must
+    # be built afresh and not be tagged as the usual version
+    if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+        return None
+
+    viewer = (g.user.id, g.user.version) if g.user else None
+    g.etag = page_etag(current_app.config['ETAG_VERSION'], request.full_path,
+                       viewer, *parts)
+
+    if request.if_none_match.contains_weak(g.etag):
+        return Response(status=304)
+
+    return None
+
+
+def apply_cache_policy(response):
+    """Tag and mark pages that opted in; forbid storing everything else.
+
+    Tagged pages may be stored but must be revalidated on each use:
+    privately when they depend on who is logged in, publicly otherwise.
+    """
+
+    etag = g.pop('etag', None)
+
+    if etag and response.status_code in (200, 304):
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        if g.user:
+            response.cache_control.private = True
+        else:
+            response.cache_control.public = True
+        response.vary.add('Cookie')
+
+    elif 'Cache-Control' not in response.headers:
+        response.cache_control.no_store = True
+
+    return response
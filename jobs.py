@@ -0,0 +1,274 @@
+"""Background jobs, queued in PostgreSQL.
+
+Views queue slow follow-up work in the same transaction as the write it
+follows from, so a job exists exactly when that write committed:
+
+    enqueue('fan_out', message_id=msg.id)
+    db.session.commit()
+
+and one or more workers run it:
+
+    flask jobs work
+
+Workers claim due jobs with SELECT ... FOR UPDATE SKIP LOCKED, so any
+number of them can share the table without running a job twice. Up to
+a handler's batch size, jobs of the same kind are passed to it in one
+call. If a batch raises, its jobs are retried one by one, so one bad
+job doesn't hold back the rest. A failing job is retried with
+exponential backoff. After max_attempts it stays in the table with
+failed_at set; `flask jobs retry` queues it again.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+from time import sleep
+
+import click
+from flask.cli import AppGroup
+
+from models import db, utcnow, User, HomeTimeline
+
+MAX_ATTEMPTS = 5
+
+# Backoff after the nth failure is RETRY_DELAY * 2 ** (n - 1), capped.
+RETRY_DELAY = timedelta(seconds=10)
+MAX_RETRY_DELAY = timedelta(hours=1)
+
+Handler = namedtuple('Handler', ['func', 'batch_size'])
+
+HANDLERS = {}
+
+
+class Job(db.Model):
+    """A queued call to the handler registered for `kind`."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.BigInteger, primary_key=True)
+
+    kind = db.Column(db.Text, nullable=False)
+
+    payload = db.Column(db.JSON, nullable=False)
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    attempts = db.Column(db.Integer, nullable=False, default=0,
+                         server_default='0')
+
+    max_attempts = db.Column(db.Integer, nullable=False, default=MAX_ATTEMPTS,
+                             server_default=str(MAX_ATTEMPTS))
+
+    last_error = db.Column(db.Text)
+
+    failed_at = db.Column(db.DateTime)
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_due', 'run_at', 'id',
+                 postgresql_where=db.text('failed_at IS NULL')),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.kind} {self.payload}>"
+
+    def fail(self, error, now):
+        """Record a failed attempt, and schedule a retry if any are left."""
+
+        self.attempts += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+
+        if self.attempts >= self.max_attempts:
+            self.failed_at = now
+        else:
+            self.run_at = now + min(RETRY_DELAY * 2 ** (self.attempts - 1),
+                                    MAX_RETRY_DELAY)
+
+
+def handler(kind, batch_size=1):
+    """Register the decorated function to run jobs of `kind`.
+
+    It's called with a list of up to `batch_size` payloads, inside the
+    worker's transaction; it shouldn't commit.
+    """
+
+    def register(func):
+        HANDLERS[kind] = Handler(func, batch_size)
+        return func
+
+    return register
+
+
+def enqueue(kind, **payload):
+    """Queue a `kind` job in the current transaction; returns the Job."""
+
+    if kind not in HANDLERS:
+        raise ValueError(f"no handler for {kind!r} jobs")
+
+    job = Job(kind=kind, payload=payload)
+    db.session.add(job)
+    return job
+
+
+def due(now):
+    return (db.select(Job)
+            .where(Job.failed_at.is_(None), Job.run_at <= now)
+            .order_by(Job.run_at, Job.id))
+
+
+def claim_batch(now):
+    """Lock the next due jobs, all of the same kind; [] if there are none."""
+
+    first = db.session.scalars(
+        due(now).limit(1).with_for_update(skip_locked=True)).first()
+    if first is None:
+        return []
+
+    batch_size = HANDLERS[first.kind].batch_size if first.kind in HANDLERS else 1
+
+    return db.session.scalars(
+        due(now)
+        .where(Job.kind == first.kind)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+    ).all()
+
+
+def run(jobs):
+    """Run a batch of same-kind jobs in a savepoint; raises if it fails."""
+
+    kind = jobs[0].kind
+    if kind not in HANDLERS:
+        raise LookupError(f"no handler for {kind!r} jobs")
+
+    with db.session.begin_nested():
+        HANDLERS[kind].func([job.payload for job in jobs])
+
+
+def run_batch(jobs, now):
+    """Run `jobs`, deleting those that succeed; returns how many failed."""
+
+    try:
+        run(jobs)
+        done, failed = jobs, 0
+    except Exception as error:
+        if len(jobs) == 1:
+            jobs[0].fail(error, now)
+            return 1
+
+        done, failed = [], 0
+        for job in jobs:
+            try:
+                run([job])
+                done.append(job)
+            except Exception as job_error:
+                job.fail(job_error, now)
+                failed += 1
+
+    for job in done:
+        db.session.delete(job)
+    return failed
+
+
+def run_pending(max_batches=None):
+    """Run due jobs until none are left; returns (ran, failed) job counts.
+
+    Each batch is committed on its own.
+    """
+
+    ran = failed = batches = 0
+
+    while max_batches is None or batches < max_batches:
+        now = datetime.utcnow()
+        jobs = claim_batch(now)
+        if not jobs:
+            db.session.commit()
+            break
+
+        failed += run_batch(jobs, now)
+        db.session.commit()
+
+        ran += len(jobs)
+        batches += 1
+
+    return ran, failed
+
+
+def register_commands(app):
+    jobs_cli = AppGroup('jobs', help="Run and inspect background jobs.")
+
+    @jobs_cli.command('work')
+    @click.option('--once', is_flag=True,
+                  help="exit when no jobs are due instead of polling")
+    @click.option('--interval', default=1.0, show_default=True,
+                  help="seconds to wait between polls of an empty queue")
+    def work(once, interval):
+        """Run background jobs as they come due."""
+
+        while True:
+            ran, failed = run_pending()
+            if ran:
+                click.echo(f"ran {ran} job(s), {failed} failed")
+            elif once:
+                return
+            else:
+                sleep(interval)
+
+    @jobs_cli.command('status')
+    def status():
+        """Show how many jobs are waiting and failed, by kind."""
+
+        rows = db.session.execute(
+            db.select(Job.kind,
+                      db.func.count().filter(Job.failed_at.is_(None)),
+                      db.func.count(Job.failed_at))
+            .group_by(Job.kind)
+            .order_by(Job.kind)
+        ).all()
+
+        for kind, waiting, failed in rows:
+            click.echo(f"{kind:<20} {waiting:>8} waiting {failed:>8} failed")
+
+    @jobs_cli.command('retry')
+    def retry():
+        """Queue failed jobs again."""
+
+        count = db.session.execute(
+            db.update(Job)
+            .where(Job.failed_at.isnot(None))
+            .values(failed_at=None, attempts=0, run_at=datetime.utcnow())
+        ).rowcount
+        db.session.commit()
+        click.echo(f"{count} job(s) queued again")
+
+    app.cli.add_command(jobs_cli)
+
+
+##############################################################################
+# Handlers
+
+
+@handler('fan_out', batch_size=500)
+def fan_out(payloads):
+    """Copy new messages into their author's followers' home timelines."""
+
+    HomeTimeline.fan_out([payload['message_id'] for payload in payloads])
+
+
+@handler('delete_user', batch_size=10)
+def delete_users(payloads):
+    """Purge hidden accounts, one step each, queueing the next step."""
+
+    for payload in payloads:
+        if User.purge(payload['user_id']):
+            enqueue('delete_user', user_id=payload['user_id'])
@@ -0,0 +1,288 @@
+"""Per-endpoint request, SQL, bcrypt and template metrics.
+
+Served at /metrics in the Prometheus text format. Metrics are kept per
+process; with several workers, scrape each one (or label them by pod).
+"""
+
+import threading
+from bisect import bisect_left
+from functools import wraps
+from time import perf_counter
+
+from flask import (Response, before_render_template, g, has_request_context,
+                   request, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+QUERY_COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+class Histogram:
+    """Cumulative-bucket histogram, as Prometheus expects."""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield repr(float(bound)), cumulative
+        yield '+Inf', cumulative + self.counts[-1]
+
+
+class Registry:
+    """Thread-safe store of counters and histograms keyed by labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+
+    def counter(self, name, help):
+        self._help[name] = ('counter', help)
+        self._counters.setdefault(name, {})
+
+    def gauge(self, name, help):
+        self._help[name] = ('gauge', help)
+        self._gauges.setdefault(name, {})
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        self._help[name] = ('histogram', help)
+        self._histograms.setdefault(name, (buckets, {}))
+
+    def inc(self, name, labels, value=1):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def set(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._gauges[name][key] = value
+
+    def observe(self, name, labels, value):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            buckets, series = self._histograms[name]
+            if key not in series:
+                series[key] = Histogram(buckets)
+            series[key].observe(value)
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format."""
+
+        lines = []
+        with self._lock:
+            for name, (kind, help) in sorted(self._help.items()):
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+
+                if kind in ('counter', 'gauge'):
+                    values = self._counters if kind == 'counter' else self._gauges
+                    for key, value in sorted(values[name].items()):
+                        lines.append(f"{name}{format_labels(key)} {value}")
+                    continue
+
+                for key, histogram in sorted(self._histograms[name][1].items()):
+                    for bound, count in histogram.samples():
+                        labels = format_labels(key + (('le', bound),))
+                        lines.append(f"{name}_bucket{labels} {count}")
+                    lines.append(f"{name}_sum{format_labels(key)} {histogram.sum}")
+                    lines.append(
+                        f"{name}_count{format_labels(key)} {sum(histogram.counts)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(key):
+    if not key:
+        return ''
+
+    return '{' + ','.join(f'{name}="{escape_label(value)}"'
+                          for name, value in key) + '}'
+
+
+def escape_label(value):
+    return (str(value)
+            .replace('\\', '\\\\')
+            .replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+registry = Registry()
+
+registry.counter('warbler_requests_total', "Requests handled, by endpoint and status.")
+registry.histogram('warbler_request_duration_seconds', "Request latency, by endpoint.")
+registry.counter('warbler_sql_queries_total', "SQL statements executed, by endpoint.")
+registry.counter('warbler_sql_seconds_total', "Time spent in SQL, by endpoint.")
+registry.histogram('warbler_sql_queries_per_request', "SQL statements per request, by endpoint.",
+                   buckets=QUERY_COUNT_BUCKETS)
+registry.histogram('warbler_sql_duration_seconds', "SQL time per request, by endpoint.")
+registry.histogram('warbler_bcrypt_duration_seconds', "Time spent hashing or checking passwords.")
+registry.histogram('warbler_template_render_seconds', "Template render time, by template.")
+registry.histogram('warbler_db_pool_wait_seconds', "Time to check a connection out of the pool, by pool.")
+registry.counter('warbler_db_pool_timeouts_total', "Checkouts that gave up after DB_POOL_TIMEOUT, by pool.")
+registry.gauge('warbler_db_pool_size', "Connections the pool keeps open, by pool.")
+registry.gauge('warbler_db_pool_checked_out', "Connections in use, by pool.")
+registry.gauge('warbler_db_pool_idle', "Open connections waiting in the pool, by pool.")
+registry.gauge('warbler_db_pool_saturation',
+               "Connections in use over pool size plus overflow, by pool.")
+
+
+def init_metrics(app, db, bcrypt):
+    """Instrument `app`, the engines of `db` and `bcrypt`; add /metrics.
+
+    Call this before registering other before_request handlers so their
+    queries are attributed to the request too.
+    """
+
+    @app.before_request
+    def start_request_timer():
+        g.metrics_start = perf_counter()
+        g.metrics_sql_count = 0
+        g.metrics_sql_seconds = 0.0
+        g.metrics_render_start = []
+
+    @app.after_request
+    def record_request(response):
+        if 'metrics_start' not in g:
+            return response
+
+        # a streamed page is still rendering (and querying) at this point,
+        # so everything is recorded once the server closes the response
+        stats = g._get_current_object()
+        endpoint = request.endpoint or 'unknown'
+        method = request.method
+
+        @response.call_on_close
+        def record():
+            labels = {'endpoint': endpoint}
+
+            registry.inc('warbler_requests_total', {
+                'endpoint': endpoint,
+                'method': method,
+                'status': response.status_code,
+            })
+            registry.observe('warbler_request_duration_seconds', labels,
+                             perf_counter() - stats.metrics_start)
+            registry.inc('warbler_sql_queries_total', labels,
+                         stats.metrics_sql_count)
+            registry.inc('warbler_sql_seconds_total', labels,
+                         stats.metrics_sql_seconds)
+            registry.observe('warbler_sql_queries_per_request', labels,
+                             stats.metrics_sql_count)
+            registry.observe('warbler_sql_duration_seconds', labels,
+                             stats.metrics_sql_seconds)
+
+        return response
+
+    with app.app_context():
+        engines = {key or 'primary': engine for key, engine in db.engines.items()}
+
+    for label, engine in engines.items():
+        watch_pool(label, engine)
+        event.listen(engine, 'before_cursor_execute', start_query_timer)
+        event.listen(engine, 'after_cursor_execute', record_query)
+
+    @before_render_template.connect_via(app)
+    def start_render_timer(sender, template, context, **extra):
+        if 'metrics_render_start' in g:
+            g.metrics_render_start.append(perf_counter())
+
+    @template_rendered.connect_via(app)
+    def record_render(sender, template, context, **extra):
+        starts = g.get('metrics_render_start')
+        if starts:
+            registry.observe('warbler_template_render_seconds',
+                             {'template': template.name},
+                             perf_counter() - starts.pop())
+
+    bcrypt.generate_password_hash = timed_bcrypt(
+        bcrypt.generate_password_hash, 'hash')
+    bcrypt.check_password_hash = timed_bcrypt(
+        bcrypt.check_password_hash, 'check')
+
+    @app.route('/metrics')
+    def metrics():
+        """Expose metrics for Prometheus to scrape."""
+
+        for label, engine in pool_engines.items():
+            record_pool_stats(label, engine.pool)
+
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
+# Engines whose pools /metrics reports, by label. Looked up on every
+# scrape, since engine.dispose() replaces the pool.
+pool_engines = {}
+
+
+def watch_pool(label, engine):
+    """Report `engine`'s pool under `label` in the pool metrics."""
+
+    engine.pool.metrics_label = label
+    pool_engines[label] = engine
+
+
+def record_pool_stats(label, pool):
+    """Set the pool gauges from `pool`'s current state."""
+
+    if not isinstance(pool, QueuePool):
+        return
+
+    labels = {'pool': label}
+    capacity = pool.size() + max(pool._max_overflow, 0)
+
+    registry.set('warbler_db_pool_size', labels, pool.size())
+    registry.set('warbler_db_pool_checked_out', labels, pool.checkedout())
+    registry.set('warbler_db_pool_idle', labels, pool.checkedin())
+    registry.set('warbler_db_pool_saturation', labels,
+                 pool.checkedout() / capacity if capacity else 0.0)
+
+
+# The start time lives on the statement's execution context, so a
+# statement that fails between the two events leaves nothing behind.
+
+def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.metrics_query_start = perf_counter()
+
+
+def record_query(conn, cursor, statement, parameters, context, executemany):
+    start = getattr(context, 'metrics_query_start', None)
+    if start is None:
+        return
+
+    if has_request_context() and 'metrics_start' in g:
+        g.metrics_sql_count += 1
+        g.metrics_sql_seconds += perf_counter() - start
+
+
+def timed_bcrypt(func, operation):
+    """Wrap a Bcrypt method so its run time is recorded."""
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            registry.observe('warbler_bcrypt_duration_seconds',
+                             {'operation': operation},
+                             perf_counter() - start)
+
+    return wrapper
@@ -0,0 +1,363 @@
+"""Versioned schema migrations.
+
+Each migration brings the schema from the previous version to its own,
+and the versions applied so far are recorded in `schema_version`. Run
+pending migrations with:
+
+    flask migrate
+
+A database created from scratch by `db.create_all()` already matches
+the models, so it is stamped with the latest version instead. A
+database with tables but no `schema_version` predates migrations and
+gets all of them.
+
+Migrations are written to run against a live, populated database:
+indexes are built with CREATE INDEX CONCURRENTLY, new columns have
+constant defaults (so adding them doesn't rewrite the table), backfills
+run in bounded batches of ids, and every step can be re-run, so a
+migration that fails halfway can simply be retried.
+"""
+
+import click
+
+from models import db, utcnow
+
+BATCH_SIZE = 10_000
+
+# Arbitrary key for pg_advisory_lock, so only one process migrates at once.
+LOCK_KEY = 7_350_121
+
+
+class Migration:
+    """A numbered list of steps.
+
+    Steps are SQL strings, consecutive ones run together in a
+    transaction, or callables such as `concurrently(...)` index builds
+    and `in_batches(...)` backfills, which manage their own connections
+    (PostgreSQL won't build an index concurrently inside a transaction).
+    """
+
+    def __init__(self, version, description, *steps):
+        self.version = version
+        self.description = description
+        self.steps = steps
+
+    def apply(self):
+        statements = []
+
+        for step in self.steps + (None,):
+            if isinstance(step, str):
+                statements.append(step)
+                continue
+
+            if statements:
+                with db.engine.begin() as connection:
+                    for statement in statements:
+                        connection.execute(db.text(statement))
+                statements = []
+
+            if step is not None:
+                step()
+
+
+def concurrently(name, table, definition, unique=False):
+    """Step building index `name` without blocking writes to `table`.
+
+    A concurrent build that fails leaves an invalid index behind, which
+    would satisfy IF NOT EXISTS; it's dropped and rebuilt instead.
+    """
+
+    def build_index():
+        with db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            valid = connection.execute(db.text(
+                "SELECT indisvalid FROM pg_index "
+                "WHERE indexrelid = to_regclass(:name)"
+            ), {'name': name}).scalar()
+
+            if valid is False:
+                connection.execute(db.text(f"DROP INDEX CONCURRENTLY {name}"))
+
+            connection.execute(db.text(
+                f"CREATE {'UNIQUE ' if unique else ''}INDEX CONCURRENTLY "
+                f"IF NOT EXISTS {name} ON {table} {definition}"
+            ))
+
+    return build_index
+
+
+def drop_concurrently(name):
+    """Step dropping index `name` without blocking writes to its table."""
+
+    def drop_index():
+        with db.engine.connect().execution_options(
+                isolation_level='AUTOCOMMIT') as connection:
+            connection.execute(db.text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+
+    return drop_index
+
+
+def in_batches(table, statement, batch_size=None, **params):
+    """Step running `statement` for each `batch_size` run of `table` ids.
+
+    The statement gets the run as :first_id and :last_id, plus `params`,
+    and each run commits on its own, so row locks are held briefly.
+    `batch_size` defaults to BATCH_SIZE.
+    """
+
+    def run_batches():
+        last_id = 0
+        while True:
+            with db.engine.begin() as connection:
+                ids = connection.execute(db.text(
+                    f"SELECT id FROM {table} WHERE id > :last_id "
+                    "ORDER BY id LIMIT :n"
+                ), {'last_id': last_id,
+                    'n': batch_size or BATCH_SIZE}).scalars().all()
+                if not ids:
+                    return
+
+                connection.execute(db.text(statement),
+                                   {'first_id': ids[0], 'last_id': ids[-1],
+                                    **params})
+                last_id = ids[-1]
+
+    return run_batches
+
+
+# Backfills are plain SQL rather than model methods, so they keep working
+# against the schema of their time as the models move on.
+
+# Copies at most :limit recent messages per follow, as a backfill on
+# follow does, so a batch's size doesn't grow with authors' histories.
+REBUILD_HOME_TIMELINES = """
+    INSERT INTO home_timeline (user_id, message_id, author_id, timestamp)
+    SELECT follows.user_following_id, recent.id, recent.user_id,
+           recent.timestamp
+    FROM follows
+    JOIN LATERAL (
+        SELECT messages.id, messages.user_id, messages.timestamp
+        FROM messages
+        WHERE messages.user_id = follows.user_being_followed_id
+        ORDER BY messages.timestamp DESC
+        LIMIT :limit
+    ) AS recent ON true
+    WHERE follows.user_following_id BETWEEN :first_id AND :last_id
+    ON CONFLICT DO NOTHING
+"""
+
+RECOUNT_USERS = """
+    UPDATE users SET
+        messages_count = (SELECT count(*) FROM messages
+                          WHERE messages.user_id = users.id),
+        following_count = (SELECT count(*) FROM follows
+                           WHERE follows.user_following_id = users.id),
+        followers_count = (SELECT count(*) FROM follows
+                           WHERE follows.user_being_followed_id = users.id),
+        likes_count = (SELECT count(*) FROM likes
+                       WHERE likes.user_id = users.id)
+    WHERE users.id BETWEEN :first_id AND :last_id
+"""
+
+# Keeps the first of each user's likes of a message. The lookup for an
+# earlier duplicate uses ix_likes_message, built just before it runs.
+DEDUPE_LIKES = """
+    WITH removed AS (
+        DELETE FROM likes
+        WHERE likes.id BETWEEN :first_id AND :last_id
+          AND EXISTS (SELECT 1 FROM likes AS earlier
+                      WHERE earlier.message_id = likes.message_id
+                        AND earlier.user_id = likes.user_id
+                        AND earlier.id < likes.id)
+        RETURNING user_id
+    )
+    UPDATE users SET
+        likes_count = likes_count - removed_count.n,
+        version = version + 1
+    FROM (SELECT user_id, count(*) AS n FROM removed GROUP BY user_id)
+        AS removed_count
+    WHERE users.id = removed_count.user_id
+"""
+
+
+MIGRATIONS = [
+    Migration(
+        1, "home timeline table",
+        """
+        CREATE TABLE IF NOT EXISTS home_timeline (
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            message_id INTEGER NOT NULL REFERENCES messages (id) ON DELETE CASCADE,
+            author_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            timestamp TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+            PRIMARY KEY (user_id, message_id)
+        )
+        """,
+        concurrently('ix_home_timeline_user_timestamp', 'home_timeline',
+                     "(user_id, timestamp, message_id)"),
+        concurrently('ix_home_timeline_user_author', 'home_timeline',
+                     "(user_id, author_id)"),
+        in_batches('users', REBUILD_HOME_TIMELINES, batch_size=1_000, limit=500),
+    ),
+    Migration(
+        2, "user counters",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS messages_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS following_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS followers_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS likes_count INTEGER NOT NULL DEFAULT 0",
+        in_batches('users', RECOUNT_USERS),
+    ),
+    Migration(
+        3, "user search index",
+        concurrently('ix_users_search', 'users',
+                     "USING gin (to_tsvector('simple', coalesce(username, '') || ' ' "
+                     "|| coalesce(bio, '') || ' ' || coalesce(location, '')))"),
+    ),
+    Migration(
+        4, "user version",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1",
+    ),
+    Migration(
+        5, "hot-path indexes, unique likes, per-insert message timestamps",
+        "ALTER TABLE messages ALTER COLUMN timestamp SET DEFAULT (now() at time zone 'utc')",
+        concurrently('ix_messages_user_timestamp', 'messages',
+                     "(user_id, timestamp, id)"),
+        concurrently('ix_follows_user_following', 'follows',
+                     "(user_following_id, user_being_followed_id)"),
+        concurrently('ix_likes_message', 'likes', "(message_id)"),
+        in_batches('likes', DEDUPE_LIKES),
+        concurrently('uq_likes_user_message', 'likes', "(user_id, message_id)",
+                     unique=True),
+        """
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint
+                           WHERE conname = 'uq_likes_user_message') THEN
+                ALTER TABLE likes ADD CONSTRAINT uq_likes_user_message
+                    UNIQUE USING INDEX uq_likes_user_message;
+            END IF;
+        END $$
+        """,
+    ),
+    Migration(
+        6, "background job queue",
+        """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind TEXT NOT NULL,
+            payload JSON NOT NULL,
+            run_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+                DEFAULT (now() at time zone 'utc'),
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 5,
+            last_error TEXT,
+            failed_at TIMESTAMP WITHOUT TIME ZONE,
+            created_at TIMESTAMP WITHOUT TIME ZONE NOT NULL
+                DEFAULT (now() at time zone 'utc')
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_jobs_due ON jobs (run_at, id) WHERE failed_at IS NULL",
+    ),
+    Migration(
+        7, "hidden accounts, home timeline message index",
+        "ALTER TABLE users ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP WITHOUT TIME ZONE",
+        "ALTER TABLE home_timeline DROP CONSTRAINT IF EXISTS home_timeline_author_id_fkey",
+        concurrently('ix_home_timeline_message', 'home_timeline', "(message_id)"),
+        concurrently('ix_users_deleted', 'users', "(id) WHERE deleted_at IS NOT NULL"),
+    ),
+    Migration(
+        8, "follow times",
+        # follows made before this get the time of the migration
+        "ALTER TABLE follows ADD COLUMN IF NOT EXISTS created_at TIMESTAMP WITHOUT TIME ZONE "
+        "NOT NULL DEFAULT (now() at time zone 'utc')",
+        concurrently('ix_follows_followers_page', 'follows',
+                     "(user_being_followed_id, created_at, user_following_id)"),
+        concurrently('ix_follows_following_page', 'follows',
+                     "(user_following_id, created_at, user_being_followed_id)"),
+        # the following page index serves every lookup this one did
+        drop_concurrently('ix_follows_user_following'),
+    ),
+]
+
+HEAD = MIGRATIONS[-1].version
+
+
+# Kept out of db.metadata, so create_all and drop_all leave it alone.
+schema_version = db.Table(
+    'schema_version',
+    db.MetaData(),
+    db.Column('version', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('description', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False,
+              server_default=utcnow()),
+)
+
+
+def ensure_version_table(connection):
+    schema_version.create(connection, checkfirst=True)
+
+
+def applied_versions():
+    with db.engine.begin() as connection:
+        ensure_version_table(connection)
+        return set(connection.execute(
+            db.text("SELECT version FROM schema_version")).scalars())
+
+
+def record(migrations):
+    with db.engine.begin() as connection:
+        ensure_version_table(connection)
+        for migration in migrations:
+            connection.execute(db.text(
+                "INSERT INTO schema_version (version, description) "
+                "VALUES (:version, :description) ON CONFLICT DO NOTHING"
+            ), {'version': migration.version,
+                'description': migration.description})
+
+
+def stamp():
+    """Record every migration as applied, e.g. after `db.create_all()`."""
+
+    record(MIGRATIONS)
+
+
+def upgrade(echo=print):
+    """Apply pending migrations in order; returns how many ran."""
+
+    with db.engine.connect().execution_options(
+            isolation_level='AUTOCOMMIT') as lock:
+        lock.execute(db.text("SELECT pg_advisory_lock(:key)"), {'key': LOCK_KEY})
+        try:
+            applied = applied_versions()
+
+            if not applied and not db.inspect(db.engine).has_table('users'):
+                echo("empty database: creating tables")
+                db.create_all()
+                stamp()
+                return 0
+
+            pending = [m for m in MIGRATIONS if m.version not in applied]
+            for migration in pending:
+                echo(f"applying {migration.version}: {migration.description}")
+                migration.apply()
+                record([migration])
+
+            return len(pending)
+        finally:
+            lock.execute(db.text("SELECT pg_advisory_unlock(:key)"), {'key': LOCK_KEY})
+
+
+def register_commands(app):
+    @app.cli.command('migrate')
+    @click.option('--list', 'show', is_flag=True,
+                  help="show applied and pending migrations instead")
+    def migrate(show):
+        """Apply pending schema migrations."""
+
+        if show:
+            applied = applied_versions()
+            for migration in MIGRATIONS:
+                state = 'applied' if migration.version in applied else 'pending'
+                click.echo(f"{migration.version:>4}  {state:<8} {migration.description}")
+            return
+
+        count = upgrade(echo=click.echo)
+        click.echo(f"{count} migration(s) applied; schema at version {HEAD}")
@@ -1,12 +1,48 @@
 """SQLAlchemy models for Warbler."""
 
+import re
+from collections import Counter
 from datetime import datetime
 
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from passwords import PasswordHasher
+from replicas import RoutingSession
 
 bcrypt = Bcrypt()
-db = SQLAlchemy()
+hasher = PasswordHasher(bcrypt)
+db = SQLAlchemy(session_options={'class_': RoutingSession})
+
+# How many of a user's most recent messages get copied into a new
+# follower's home timeline.
+TIMELINE_BACKFILL_LIMIT = 500
+
+# User search never looks further down the ranking than this.
+SEARCH_MAX_RESULTS = 240
+
+# Rows a deleted account's background purge removes per step.
+PURGE_BATCH_SIZE = 5_000
+
+
+class utcnow(FunctionElement):
+    """Current UTC time as a naive timestamp, for server defaults."""
+
+    type = db.DateTime()
+    inherit_cache = True
+
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return "CURRENT_TIMESTAMP"
+
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "(now() at time zone 'utc')"
 
 
 class Follows(db.Model):
@@ -26,6 +62,23 @@ class Follows(db.Model):
         primary_key=True,
     )
 
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+        server_default=utcnow(),
+    )
+
+    # The primary key covers "who follows X"; ix_follows_following_page
+    # covers "who does X follow". Both page indexes list their side newest
+    # follow first, as the followers and following pages do.
+    __table_args__ = (
+        db.Index('ix_follows_followers_page', 'user_being_followed_id',
+                 'created_at', 'user_following_id'),
+        db.Index('ix_follows_following_page', 'user_following_id',
+                 'created_at', 'user_being_followed_id'),
+    )
+
 
 class Likes(db.Model):
     """Mapping user likes to warbles."""
@@ -47,6 +100,242 @@ class Likes(db.Model):
         db.ForeignKey('messages.id', ondelete='cascade')
     )
 
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'message_id',
+                            name='uq_likes_user_message'),
+        db.Index('ix_likes_message', 'message_id'),
+    )
+
+    # Each of these is a single statement, so concurrent clicks can't
+    # duplicate or double-remove a like; the liker's likes_count is only
+    # adjusted when a row actually changed.
+
+    @classmethod
+    def add(cls, user_id, message_id):
+        """Like a message. Returns False if already liked or no such message."""
+
+        added = db.session.execute(
+            postgresql.insert(cls)
+            .from_select(['user_id', 'message_id'],
+                         db.select(db.literal(user_id), Message.id)
+                         .where(Message.id == message_id))
+            .on_conflict_do_nothing(constraint='uq_likes_user_message')
+            .returning(cls.id)
+        ).first() is not None
+
+        if added:
+            User.adjust_counts(user_id, likes_count=1)
+        return added
+
+    @classmethod
+    def remove(cls, user_id, message_id):
+        """Unlike a message. Returns False if it wasn't liked."""
+
+        removed = db.session.execute(
+            db.delete(cls)
+            .where(cls.user_id == user_id, cls.message_id == message_id)
+            .returning(cls.id)
+        ).first() is not None
+
+        if removed:
+            User.adjust_counts(user_id, likes_count=-1)
+        return removed
+
+    @classmethod
+    def toggle(cls, user_id, message_id):
+        """Unlike the message if liked, else like it; returns the new state."""
+
+        if cls.remove(user_id, message_id):
+            return False
+
+        return cls.add(user_id, message_id)
+
+    @classmethod
+    def state(cls, user_id, message_id):
+        """Return (liked by `user_id`, total likes) for a message."""
+
+        liked, count = db.session.execute(
+            db.select(db.func.coalesce(db.func.bool_or(cls.user_id == user_id),
+                                       False),
+                      db.func.count())
+            .where(cls.message_id == message_id)
+        ).one()
+        return liked, count
+
+
+def search_document(username, bio, location):
+    """Full-text document that `User.search` matches against.
+
+    Also the expression of the `ix_users_search` GIN index; the two must
+    render identically for PostgreSQL to use the index.
+    """
+
+    return db.func.to_tsvector(
+        db.literal_column("'simple'"),
+        db.func.coalesce(username, '') + ' '
+        + db.func.coalesce(bio, '') + ' '
+        + db.func.coalesce(location, ''),
+    )
+
+
+class HomeTimeline(db.Model):
+    """Materialized home timeline: one row per message per follower.
+
+    Rows are fanned out when a message is posted and backfilled/pruned
+    when a follow is added/removed, so reading a home page is a single
+    range scan over (user_id, timestamp) regardless of follow count.
+    """
+
+    __tablename__ = 'home_timeline'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    # No foreign key: rows go with their message's, and a key here would
+    # make deleting a user scan the whole table.
+    author_id = db.Column(
+        db.Integer,
+        nullable=False,
+    )
+
+    timestamp = db.Column(
+        db.DateTime,
+        nullable=False,
+    )
+
+    __table_args__ = (
+        db.Index('ix_home_timeline_user_timestamp',
+                 'user_id', 'timestamp', 'message_id'),
+        db.Index('ix_home_timeline_user_author', 'user_id', 'author_id'),
+        # for the cascade when a message is deleted
+        db.Index('ix_home_timeline_message', 'message_id'),
+    )
+
+    @classmethod
+    def fan_out(cls, message_ids):
+        """Add messages to the home timeline of each follower of their author.
+
+        Follows are read as they are now, so the messages reach whoever
+        follows the author when this runs. Rows already there (say, from
+        a backfill since the message was posted) are left alone.
+        """
+
+        followers = (db.select(
+                         Follows.user_following_id,
+                         Message.id,
+                         Message.user_id,
+                         Message.timestamp,
+                     )
+                     .join(Follows, Follows.user_being_followed_id == Message.user_id)
+                     .where(Message.id.in_(message_ids)))
+
+        db.session.execute(
+            postgresql.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                followers,
+            ).on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def backfill(cls, user_id, author_id):
+        """Copy `author_id`'s recent messages into `user_id`'s timeline.
+
+        Rows already there, say from a `fan_out` job that ran in the
+        meantime, are left alone.
+        """
+
+        recent = (db.select(
+                      db.literal(user_id),
+                      Message.id,
+                      Message.user_id,
+                      Message.timestamp,
+                  )
+                  .where(Message.user_id == author_id)
+                  .order_by(Message.timestamp.desc())
+                  .limit(TIMELINE_BACKFILL_LIMIT))
+
+        db.session.execute(
+            postgresql.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                recent,
+            ).on_conflict_do_nothing()
+        )
+
+    @classmethod
+    def prune(cls, user_id, author_id):
+        """Remove `author_id`'s messages from `user_id`'s timeline."""
+
+        db.session.execute(
+            db.delete(cls).where(cls.user_id == user_id,
+                                 cls.author_id == author_id)
+        )
+
+    @classmethod
+    def rebuild(cls, user_ids=None):
+        """Recompute home timelines from follows and messages.
+
+        Rebuilds everyone's, or only those of `user_ids`. Used after bulk
+        loads (e.g. seed.py), which bypass the fan-out. Like `backfill`,
+        it takes at most TIMELINE_BACKFILL_LIMIT messages per followed
+        author; on large tables, call it for batches of user ids and
+        commit in between.
+        """
+
+        stale = db.delete(cls)
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            recent = (db.select(Message.id, Message.user_id, Message.timestamp)
+                      .where(Message.user_id == Follows.user_being_followed_id)
+                      .order_by(Message.timestamp.desc())
+                      .limit(TIMELINE_BACKFILL_LIMIT)
+                      .lateral())
+            rows = db.select(
+                Follows.user_following_id,
+                recent.c.id,
+                recent.c.user_id,
+                recent.c.timestamp,
+            ).join(recent, db.true())
+        else:
+            ranked = db.select(
+                Message.id,
+                Message.user_id,
+                Message.timestamp,
+                db.func.row_number().over(
+                    partition_by=Message.user_id,
+                    order_by=Message.timestamp.desc(),
+                ).label('rank'),
+            ).subquery()
+            rows = db.select(
+                Follows.user_following_id,
+                ranked.c.id,
+                ranked.c.user_id,
+                ranked.c.timestamp,
+            ).join(ranked, db.and_(
+                ranked.c.user_id == Follows.user_being_followed_id,
+                ranked.c.rank <= TIMELINE_BACKFILL_LIMIT,
+            ))
+
+        if user_ids is not None:
+            stale = stale.where(cls.user_id.in_(user_ids))
+            rows = rows.where(Follows.user_following_id.in_(user_ids))
+
+        db.session.execute(stale)
+        db.session.execute(
+            db.insert(cls).from_select(
+                ['user_id', 'message_id', 'author_id', 'timestamp'],
+                rows,
+            )
+        )
+
 
 class User(db.Model):
     """User in the system."""
@@ -93,25 +382,91 @@ class User(db.Model):
         nullable=False,
     )
 
-    messages = db.relationship('Message', cascade="all, delete-orphan")
+    # Denormalized counters, kept in step by the views via `adjust_counts`
+    # and recomputed in bulk by `recount_stats`.
+
+    messages_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    following_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    followers_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    likes_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
+    # Bumped whenever anything shown about this user changes (counters
+    # via `adjust_counts`, profile edits via `bump_version`), so pages
+    # showing the user can be revalidated by ETag.
+
+    version = db.Column(
+        db.Integer,
+        nullable=False,
+        default=1,
+        server_default='1',
+    )
+
+    # Set when the account is deleted; it's hidden from then on, while
+    # `purge` removes its rows in the background.
+
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    __table_args__ = (
+        db.Index(
+            'ix_users_search',
+            search_document(username, bio, location),
+            postgresql_using='gin',
+        ).ddl_if(dialect='postgresql'),
+        db.Index('ix_users_deleted', 'id',
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+    )
+
+    # The database cascades deletes to these rows (see `purge`), so the
+    # ORM never has to load them to delete a user.
+
+    messages = db.relationship('Message', cascade="all, delete-orphan",
+                               passive_deletes=True)
 
     followers = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_being_followed_id == id),
-        secondaryjoin=(Follows.user_following_id == id)
+        secondaryjoin=(Follows.user_following_id == id),
+        passive_deletes=True,
     )
 
     following = db.relationship(
         "User",
         secondary="follows",
         primaryjoin=(Follows.user_following_id == id),
-        secondaryjoin=(Follows.user_being_followed_id == id)
+        secondaryjoin=(Follows.user_being_followed_id == id),
+        passive_deletes=True,
     )
 
     likes = db.relationship(
         'Message',
-        secondary="likes"
+        secondary="likes",
+        passive_deletes=True,
     )
 
     def __repr__(self):
@@ -120,14 +475,275 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_user`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return db.session.query(
+            db.exists().where(
+                Follows.user_following_id == self.id,
+                Follows.user_being_followed_id == other_user.id,
+            )
+        ).scalar()
+
+    def following_ids_among(self, user_ids):
+        """Which of `user_ids` does this user follow?
+
+        Resolves follow state for a whole page of users in one query on
+        the follows primary key, instead of a check per user.
+        """
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_being_followed_id)
+            .where(Follows.user_following_id == self.id,
+                   Follows.user_being_followed_id.in_(user_ids))
+        ))
+
+    def follower_ids_among(self, user_ids):
+        """Which of `user_ids` follow this user?"""
+
+        user_ids = set(user_ids)
+        if not user_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Follows.user_following_id)
+            .where(Follows.user_being_followed_id == self.id,
+                   Follows.user_following_id.in_(user_ids))
+        ))
+
+    def liked_ids_among(self, message_ids):
+        """Which of `message_ids` has this user liked?
+
+        Lets a page of messages render its like buttons with one query,
+        however many messages the user has liked over time.
+        """
+
+        message_ids = set(message_ids)
+        if not message_ids:
+            return set()
+
+        return set(db.session.scalars(
+            db.select(Likes.message_id)
+            .where(Likes.user_id == self.id,
+                   Likes.message_id.in_(message_ids))
+        ))
+
+    @classmethod
+    def visible(cls):
+        """Query of users whose accounts haven't been deleted."""
+
+        return cls.query.filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def hidden_ids(cls):
+        """Select of the ids of deleted accounts not purged yet.
+
+        There are only ever a few, so `.notin_(User.hidden_ids())` is a
+        cheap way to drop their messages without joining users.
+        """
+
+        return db.select(cls.id).where(cls.deleted_at.isnot(None))
+
+    def hide(self):
+        """Delete the account as far as everyone else can see.
+
+        Its rows are removed later by `purge`, in a background job.
+        """
+
+        self.deleted_at = datetime.utcnow()
+        self.bump_version()
+
+    @classmethod
+    def purge(cls, user_id):
+        """Delete up to PURGE_BATCH_SIZE rows of a hidden account.
+
+        Call repeatedly, committing in between, until it returns False:
+        it removes the account's messages, follows, likes and home
+        timeline, and finally the user row itself. A batch of messages
+        first loses its timeline rows and likes, PURGE_BATCH_SIZE at a
+        time, so the delete's cascade has nothing left to do however
+        many followers and likers the account has. Other users' counters
+        are adjusted along with each step, so they stay right whenever
+        it stops.
+        """
+
+        message_ids = db.session.scalars(
+            db.select(Message.id).where(Message.user_id == user_id)
+            .order_by(Message.id)
+            .limit(PURGE_BATCH_SIZE)).all()
+
+        if message_ids:
+            timeline_rows = (db.select(HomeTimeline.user_id, HomeTimeline.message_id)
+                             .where(HomeTimeline.message_id.in_(message_ids))
+                             .limit(PURGE_BATCH_SIZE))
+            if db.session.execute(
+                    db.delete(HomeTimeline)
+                    .where(db.tuple_(HomeTimeline.user_id,
+                                     HomeTimeline.message_id).in_(timeline_rows))
+            ).rowcount:
+                return True
+
+            likers = db.session.scalars(
+                db.delete(Likes)
+                .where(Likes.id.in_(db.select(Likes.id)
+                                    .where(Likes.message_id.in_(message_ids))
+                                    .limit(PURGE_BATCH_SIZE)))
+                .returning(Likes.user_id)).all()
+            if likers:
+                # a liker may have liked several of the messages
+                by_count = {}
+                for liker_id, count in Counter(likers).items():
+                    by_count.setdefault(count, []).append(liker_id)
+                for count, liker_ids in by_count.items():
+                    cls.adjust_counts(liker_ids, likes_count=-count)
+                return True
+
+            db.session.execute(
+                db.delete(Message).where(Message.id.in_(message_ids)))
+            return True
+
+        for own, other, counter in (
+                (Follows.user_following_id, Follows.user_being_followed_id,
+                 'followers_count'),
+                (Follows.user_being_followed_id, Follows.user_following_id,
+                 'following_count')):
+            other_ids = db.session.scalars(
+                db.select(other).where(own == user_id).limit(PURGE_BATCH_SIZE)).all()
+
+            if other_ids:
+                cls.adjust_counts(other_ids, **{counter: -1})
+                db.session.execute(
+                    db.delete(Follows).where(own == user_id, other.in_(other_ids)))
+                return True
+
+        for model, column in ((Likes, Likes.message_id),
+                              (HomeTimeline, HomeTimeline.message_id)):
+            ids = db.session.scalars(
+                db.select(column).where(model.user_id == user_id)
+                .limit(PURGE_BATCH_SIZE)).all()
+
+            if ids:
+                db.session.execute(
+                    db.delete(model).where(model.user_id == user_id,
+                                           column.in_(ids)))
+                return True
+
+        db.session.execute(db.delete(cls).where(cls.id == user_id))
+        return False
+
+    @classmethod
+    def adjust_counts(cls, user_id, **deltas):
+        """Atomically add `deltas` to counter columns, e.g. messages_count=1.
+
+        `user_id` is a single id, or a list or select of ids. The increment happens
+        in the UPDATE itself, so concurrent requests can't lose updates.
+        Also bumps `version`.
+        """
+
+        if isinstance(user_id, int):
+            condition = cls.id == user_id
+        else:
+            condition = cls.id.in_(user_id)
+
+        db.session.execute(
+            db.update(cls)
+            .where(condition)
+            .values({
+                getattr(cls, name): getattr(cls, name) + delta
+                for name, delta in deltas.items()
+            } | {cls.version: cls.version + 1})
+        )
+
+    def bump_version(self):
+        """Mark this user's profile as changed, in the UPDATE itself."""
+
+        self.version = User.version + 1
+
+    @classmethod
+    def recount_stats(cls, user_ids=None):
+        """Recompute counter columns from the underlying tables.
+
+        Recounts every user, or only `user_ids` (a list or select of ids),
+        in a single set-based UPDATE.
+        """
+
+        def count(model, column):
+            return (db.select(db.func.count())
+                    .select_from(model)
+                    .where(column == cls.id)
+                    .scalar_subquery())
+
+        stmt = db.update(cls).values(
+            messages_count=count(Message, Message.user_id),
+            following_count=count(Follows, Follows.user_following_id),
+            followers_count=count(Follows, Follows.user_being_followed_id),
+            likes_count=count(Likes, Likes.user_id),
+            version=cls.version + 1,
+        )
+
+        if user_ids is not None:
+            stmt = stmt.where(cls.id.in_(user_ids))
+
+        db.session.execute(stmt, execution_options={'synchronize_session': False})
+
+    @classmethod
+    def search(cls, term, page, per_page):
+        """Find users matching `term` in their username, bio or location.
+
+        Returns `(users, has_more)` for the 1-based `page`, best matches
+        first: exact and prefix username matches are boosted above
+        full-text rank. Results are capped at SEARCH_MAX_RESULTS.
+
+        On PostgreSQL this uses the GIN-indexed tsvector in
+        `search_document`; other databases fall back to LIKE.
+        """
+
+        words = re.findall(r"\w+", term.lower())
+        offset = (page - 1) * per_page
+        limit = min(per_page, SEARCH_MAX_RESULTS - offset)
+
+        if not words or limit <= 0:
+            return [], False
+
+        username = db.func.lower(cls.username)
+        boost = db.case(
+            (username == words[0], 2.0),
+            (username.startswith(words[0], autoescape=True), 1.0),
+            else_=0.0,
+        )
+
+        if db.session.get_bind().dialect.name == 'postgresql':
+            query = db.func.to_tsquery(
+                db.literal_column("'simple'"),
+                " & ".join(f"{word}:*" for word in words),
+            )
+            document = search_document(cls.username, cls.bio, cls.location)
+            matches = document.op('@@')(query)
+            rank = boost + db.func.ts_rank(document, query)
+        else:
+            matches = db.and_(*(
+                db.or_(*(db.func.lower(column).contains(word, autoescape=True)
+                         for column in (cls.username, cls.bio, cls.location)))
+                for word in words
+            ))
+            rank = boost
+
+        users = (cls.visible()
+                 .filter(matches)
+                 .order_by(rank.desc(), cls.id)
+                 .offset(offset)
+                 .limit(limit + 1)
+                 .all())
+
+        has_more = (len(users) > limit
+                    and offset + limit < SEARCH_MAX_RESULTS)
+        return users[:limit], has_more
 
     @classmethod
     def signup(cls, username, email, password, image_url):
@@ -136,7 +752,7 @@ class User(db.Model):
         Hashes password and adds user to system.
         """
 
-        hashed_pwd = bcrypt.generate_password_hash(password).decode('UTF-8')
+        hashed_pwd = hasher.hash(password)
 
         user = User(
             username=username,
@@ -157,13 +773,18 @@ class User(db.Model):
         and, if it finds such a user, returns that user object.
 
         If can't find matching user (or if password is wrong), returns False.
+
+        A password hashed at a different cost than BCRYPT_LOG_ROUNDS is
+        rehashed; the caller commits it.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.visible().filter_by(username=username).first()
 
         if user:
-            is_auth = bcrypt.check_password_hash(user.password, password)
+            is_auth = hasher.check(user.password, password)
             if is_auth:
+                if hasher.needs_rehash(user.password):
+                    user.password = hasher.hash(password)
                 return user
 
         return False
@@ -187,7 +808,8 @@ class Message(db.Model):
     timestamp = db.Column(
         db.DateTime,
         nullable=False,
-        default=datetime.utcnow(),
+        default=datetime.utcnow,
+        server_default=utcnow(),
     )
 
     user_id = db.Column(
@@ -198,6 +820,11 @@ class Message(db.Model):
 
     user = db.relationship('User')
 
+    # Profile pages list a user's messages newest first.
+    __table_args__ = (
+        db.Index('ix_messages_user_timestamp', 'user_id', 'timestamp', 'id'),
+    )
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -207,4 +834,5 @@ def connect_db(app):
 
     db.app = app
     db.init_app(app)
+    hasher.init_app(app)
     app.app_context().push()
\ No newline at end of file
@@ -0,0 +1,108 @@
+"""Keyset (cursor) pagination for Warbler list pages."""
+
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import BigInteger, DateTime, tuple_
+
+MESSAGES_PER_PAGE = 100
+USERS_PER_PAGE = 24
+
+Page = namedtuple('Page', ['items', 'next_cursor'])
+
+
+def encode_cursor(*values):
+    """Encode a row's sort key as an opaque, URL-safe token."""
+
+    raw = json.dumps([
+        value.isoformat() if isinstance(value, datetime) else value
+        for value in values
+    ])
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(token, columns):
+    """Decode a token made by `encode_cursor` into values for `columns`.
+
+    Aborts with a 400 if the token was tampered with or is malformed,
+    including values of the wrong type for their column, which would
+    otherwise only fail in the database.
+    """
+
+    try:
+        padded = token + '=' * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded))
+        if not isinstance(values, list) or len(values) != len(columns):
+            raise ValueError(token)
+
+        return [decode_value(column, value)
+                for column, value in zip(columns, values)]
+
+    except (binascii.Error, TypeError, ValueError, UnicodeDecodeError):
+        abort(400)
+
+
+def decode_value(column, value):
+    if isinstance(column.type, DateTime):
+        return datetime.fromisoformat(value)
+
+    python_type = column.type.python_type
+    if type(value) is not python_type:
+        raise TypeError(value)
+
+    if python_type is int:
+        bits = 64 if isinstance(column.type, BigInteger) else 32
+        if not -2 ** (bits - 1) <= value < 2 ** (bits - 1):
+            raise ValueError(value)
+
+    return value
+
+
+def keyset_page(query, columns, key, before=None, per_page=MESSAGES_PER_PAGE):
+    """Fetch one page of `query`, newest first, keyed on `columns`.
+
+    `columns` are the sort columns (most significant first, the last one
+    unique), `key` maps a result row to its values for those columns and
+    `before` is the cursor handed out with the previous page. Instead of
+    an OFFSET, each page continues strictly below the last row seen, so
+    deep pages cost the same as the first one.
+    """
+
+    rows = keyset_query(query, columns, before, per_page).all()
+    return page_of(rows, key, per_page)
+
+
+async def keyset_page_async(session, statement, columns, key, before=None,
+                            per_page=MESSAGES_PER_PAGE):
+    """`keyset_page` for an ORM select run on an AsyncSession."""
+
+    result = await session.scalars(
+        keyset_query(statement, columns, before, per_page))
+    return page_of(result.all(), key, per_page)
+
+
+def keyset_query(query, columns, before, per_page):
+    """`query` (a Query or select) limited to the page below `before`.
+
+    One row more than `per_page` is fetched, to tell if there's a next page.
+    """
+
+    if before:
+        query = query.filter(
+            tuple_(*columns) < tuple_(*decode_cursor(before, columns)))
+
+    return (query
+            .order_by(*(column.desc() for column in columns))
+            .limit(per_page + 1))
+
+
+def page_of(rows, key, per_page):
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        return Page(rows, encode_cursor(*key(rows[-1])))
+
+    return Page(rows, None)
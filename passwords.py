@@ -0,0 +1,81 @@
+"""Bounded pool for bcrypt work.
+
+bcrypt is deliberately slow, so a burst of logins or signups run on the
+request threads could tie up every worker. Hashing and checking go
+through a small thread pool instead (bcrypt releases the GIL while it
+works): at most BCRYPT_WORKERS run at once, at most BCRYPT_QUEUE_LIMIT
+more wait, and anything beyond that fails fast with PasswordHasherBusy
+so the app can answer 503 while ordinary pages keep being served.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing pool and its queue are both full."""
+
+
+class PasswordHasher:
+    """Run `bcrypt`'s hash and check methods on a bounded thread pool."""
+
+    def __init__(self, bcrypt):
+        self.bcrypt = bcrypt
+        self.rounds = 12
+        self._executor = None
+        self._slots = None
+
+    def init_app(self, app):
+        app.config.setdefault('BCRYPT_LOG_ROUNDS', 12)
+        app.config.setdefault('BCRYPT_WORKERS', os.cpu_count() or 1)
+        app.config.setdefault('BCRYPT_QUEUE_LIMIT', 16)
+
+        self.bcrypt.init_app(app)
+        self.rounds = app.config['BCRYPT_LOG_ROUNDS']
+
+        workers = app.config['BCRYPT_WORKERS']
+        if self._executor:
+            self._executor.shutdown(wait=False)
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(
+            workers + app.config['BCRYPT_QUEUE_LIMIT'])
+
+    def _run(self, func):
+        if self._executor is None:
+            return func()
+
+        if not self._slots.acquire(blocking=False):
+            raise PasswordHasherBusy()
+
+        try:
+            future = self._executor.submit(func)
+        except BaseException:
+            self._slots.release()
+            raise
+
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        """Hash `password` at the configured cost."""
+
+        # look the method up on each call, so instrumentation wrapped
+        # around it after init_app still applies
+        return self._run(
+            lambda: self.bcrypt.generate_password_hash(password, self.rounds)
+        ).decode('UTF-8')
+
+    def check(self, pw_hash, password):
+        """Return whether `password` matches `pw_hash`."""
+
+        return self._run(
+            lambda: self.bcrypt.check_password_hash(pw_hash, password))
+
+    def needs_rehash(self, pw_hash):
+        """Return whether `pw_hash` was made at a different cost."""
+
+        try:
+            return int(pw_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return True
@@ -0,0 +1,55 @@
+"""Query-count guard for catching N+1 regressions in tests."""
+
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+from models import db
+
+
+class QueryCounter:
+    """SQL statements executed while a `count_queries` block was open."""
+
+    def __init__(self):
+        self.statements = []
+
+    @property
+    def count(self):
+        return len(self.statements)
+
+
+@contextmanager
+def count_queries():
+    """Record every statement sent to the database inside the block."""
+
+    counter = QueryCounter()
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        counter.statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record)
+    try:
+        yield counter
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record)
+
+
+class QueryBudgetMixin:
+    """TestCase mixin that fails a test when a block runs too many queries.
+
+    The session is emptied first, so rows loaded earlier in the test can't
+    hide lazy loads behind the identity map.
+    """
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        db.session.expunge_all()
+
+        with count_queries() as counter:
+            yield counter
+
+        if counter.count > budget:
+            self.fail(
+                f"{counter.count} queries exceeds budget of {budget}:\n"
+                + "\n\n".join(counter.statements)
+            )
@@ -0,0 +1,91 @@
+"""Read replicas.
+
+Set DATABASE_REPLICA_URLS to a comma-separated list of replica URLs and
+views marked `@read_replica` run their queries against one of them,
+picked at random per request; everything else, and anything a read view
+flushes, goes to the primary at DATABASE_URL.
+
+Replicas lag the primary a little, so a client that has just written
+(any successful POST, PUT, PATCH or DELETE) is kept on the primary for
+REPLICA_STICKY_SECONDS: people see their own new messages and follows
+straight away. The deadline lives in the session cookie, so it holds
+whichever worker serves the next request.
+"""
+
+import random
+from functools import wraps
+from time import time
+
+from flask import current_app, g, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+
+REPLICA_BIND_PREFIX = 'replica-'
+
+STICKY_KEY = 'primary_until'
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def replica_binds(urls):
+    """SQLALCHEMY_BINDS entries for comma-separated replica `urls`."""
+
+    return {f'{REPLICA_BIND_PREFIX}{i}': url.strip()
+            for i, url in enumerate(urls.split(','))
+            if url.strip()}
+
+
+class RoutingSession(Session):
+    """Session sending a read view's queries to its replica."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_request_context():
+            replica = g.get('db_replica')
+            if replica is not None:
+                return self._db.engines[replica]
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_replica(view):
+    """Run `view`'s queries on a replica, unless the client just wrote."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        engines = current_app.extensions['sqlalchemy'].engines
+        replicas = [key for key in engines
+                    if key and key.startswith(REPLICA_BIND_PREFIX)]
+
+        if replicas and session.get(STICKY_KEY, 0) <= time():
+            g.db_replica = random.choice(replicas)
+
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+def init_replicas(app, db):
+    """Add stickiness after writes and end replica reads with each request."""
+
+    app.config.setdefault('REPLICA_STICKY_SECONDS', 5)
+
+    @app.before_request
+    def use_primary():
+        # connect_db leaves an app context pushed, so `g` can outlive a
+        # request; start every request on the primary
+        g.pop('db_replica', None)
+
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method not in SAFE_METHODS and response.status_code < 400:
+            session[STICKY_KEY] = time() + app.config['REPLICA_STICKY_SECONDS']
+        elif STICKY_KEY in session and session[STICKY_KEY] <= time():
+            session.pop(STICKY_KEY)
+
+        return response
+
+    @app.teardown_request
+    def release_replica(exc):
+        # runs once a streamed page has finished too; don't hold a
+        # replica transaction open between requests
+        if g.pop('db_replica', None) is not None:
+            db.session.rollback()
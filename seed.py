@@ -1,30 +1,201 @@
-"""Seed database with sample data from CSV Files."""
+"""Seed database with sample data from CSV Files.
 
+    python seed.py           # load generator/*.csv through the ORM
+    python seed.py --bulk    # stream them in with COPY, for large datasets
+
+Large generated tables are split into shards (users-00000.csv, ...);
+they are loaded in name order, since user ids follow row order.
+
+The bulk mode streams each CSV straight into the database (COPY FROM
+STDIN on PostgreSQL, chunked executemany elsewhere), builds secondary
+indexes only after the data is in, and does the post-load fixups as
+set-based statements, rebuilding home timelines in batches of users.
+"""
+
+import argparse
+import csv
+import itertools
+import os
+from contextlib import contextmanager
 from csv import DictReader
+from glob import glob
+
+import migrations
 from app import db
-from models import User, Message, Follows
+from models import User, Message, Follows, HomeTimeline
+
+HEADER_IMAGE_URL = "/static/images/warbler-hero.jpg"
+
+DATA_DIR = 'generator'
+
+CSV_TABLES = [User, Message, Follows]
+
+CHUNK_SIZE = 10_000
+
+# Users whose home timelines are rebuilt per transaction.
+TIMELINE_BATCH_SIZE = 1_000
+
+
+def csv_files(data_dir=DATA_DIR):
+    """Yield (model, path) for every CSV (or CSV shard) to load, in order."""
+
+    for model in CSV_TABLES:
+        name = model.__tablename__
+        paths = glob(os.path.join(data_dir, f'{name}.csv'))
+        paths += sorted(glob(os.path.join(data_dir, f'{name}-*.csv')))
+
+        for path in paths:
+            yield model, path
+
+
+def seed_orm(data_dir=DATA_DIR):
+    """Load the CSVs through the ORM; fine for the small sample data."""
+
+    for model, path in csv_files(data_dir):
+        with open(path) as rows:
+            db.session.bulk_insert_mappings(model, DictReader(rows))
+
+    db.session.commit()
+
+
+@contextmanager
+def deferred_indexes():
+    """Drop secondary indexes for the duration of the block, then rebuild them.
+
+    Building an index once over loaded data is much cheaper than
+    maintaining it row by row during the load.
+    """
+
+    indexes = [index
+               for table in db.metadata.sorted_tables
+               for index in table.indexes]
+
+    for index in indexes:
+        index.drop(db.engine, checkfirst=True)
+
+    yield
+
+    for index in indexes:
+        index.create(db.engine, checkfirst=True)
+
+
+def copy_csv(model, path):
+    """Stream a CSV file into `model`'s table with COPY FROM STDIN."""
+
+    with open(path) as f:
+        columns = next(csv.reader(f))
+        f.seek(0)
+
+        connection = db.engine.raw_connection()
+        try:
+            with connection.cursor() as cursor:
+                cursor.copy_expert(
+                    f"COPY {model.__tablename__} ({', '.join(columns)}) "
+                    "FROM STDIN WITH (FORMAT csv, HEADER true)",
+                    f,
+                )
+            connection.commit()
+        finally:
+            connection.close()
+
+
+def insert_csv(model, path):
+    """Load a CSV file into `model`'s table in executemany chunks."""
+
+    with open(path) as f:
+        reader = DictReader(f)
+        insert = db.text(
+            f"INSERT INTO {model.__tablename__} ({', '.join(reader.fieldnames)}) "
+            f"VALUES ({', '.join(':' + name for name in reader.fieldnames)})"
+        )
+
+        while chunk := list(itertools.islice(reader, CHUNK_SIZE)):
+            db.session.execute(insert, chunk)
+
+    db.session.commit()
+
+
+def reset_sequences():
+    """Point each id sequence past the largest id that was loaded."""
+
+    for model in (User, Message):
+        table = model.__tablename__
+        db.session.execute(db.text(
+            f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+            f"coalesce(max(id), 1), max(id) IS NOT NULL) FROM {table}"
+        ))
+
+    db.session.commit()
+
+
+def seed_bulk(data_dir=DATA_DIR):
+    """Stream the CSVs in, with indexes built once at the end."""
+
+    postgres = db.engine.dialect.name == 'postgresql'
+    load = copy_csv if postgres else insert_csv
+
+    with deferred_indexes():
+        for model, path in csv_files(data_dir):
+            print(f"loading {path}")
+            load(model, path)
+
+        if postgres:
+            reset_sequences()
+
+    # after the indexes are back: the timeline rebuild reads messages by author
+    fix_up()
+
+
+def fix_up():
+    """Set-based fixups for rows that came in from the CSVs."""
+
+    # changed bg image because other one doesn't work
+    db.session.execute(db.update(User).values(header_image_url=HEADER_IMAGE_URL))
+
+    db.session.commit()
+
+    rebuild_home_timelines()
+
+
+def rebuild_home_timelines():
+    """Rebuild every home timeline, TIMELINE_BATCH_SIZE users per commit."""
 
+    last_id = 0
+    while user_ids := db.session.scalars(
+            db.select(User.id)
+            .where(User.id > last_id)
+            .order_by(User.id)
+            .limit(TIMELINE_BATCH_SIZE)).all():
+        HomeTimeline.rebuild(user_ids)
+        db.session.commit()
+        last_id = user_ids[-1]
 
-db.drop_all()
-db.create_all()
 
-with open('generator/users.csv') as users:
-    db.session.bulk_insert_mappings(User, DictReader(users))
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bulk', action='store_true',
+                        help="stream CSVs with COPY instead of the ORM")
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help="directory holding the generated CSVs")
+    args = parser.parse_args()
 
-with open('generator/messages.csv') as messages:
-    db.session.bulk_insert_mappings(Message, DictReader(messages))
+    db.drop_all()
+    db.create_all()
+    migrations.stamp()
 
-with open('generator/follows.csv') as follows:
-    db.session.bulk_insert_mappings(Follows, DictReader(follows))
+    if args.bulk:
+        seed_bulk(args.data_dir)
+    else:
+        seed_orm(args.data_dir)
+        fix_up()
 
-db.session.commit()
+    u = User.signup(username='catman', email='skvaladez@yahoo.com', password='goodpassword', image_url='https://i.natgeofe.com/n/548467d8-c5f1-4551-9f58-6817a8d2c45e/NationalGeographic_2572187_square.jpg')
+    db.session.add(u)
+    db.session.commit()
 
-# changed bg image because other one doesn't work
-for user in User.query.all():
-    user.header_image_url = "/static/images/warbler-hero.jpg"
+    User.recount_stats()
+    db.session.commit()
 
-db.session.commit()
 
-u = User.signup(username='catman', email='skvaladez@yahoo.com', password='goodpassword', image_url='https://i.natgeofe.com/n/548467d8-c5f1-4551-9f58-6817a8d2c45e/NationalGeographic_2572187_square.jpg')
-db.session.add(u)
-db.session.commit()
+if __name__ == '__main__':
+    main()
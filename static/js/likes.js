@@ -0,0 +1,32 @@
+// Like buttons: toggle the like in place through the JSON endpoint
+// instead of posting the form and reloading the page. Without JS (or if
+// the request fails) the form posts as usual.
+
+document.addEventListener('submit', async function (evt) {
+  const form = evt.target.closest('.like-form');
+  if (!form) return;
+
+  evt.preventDefault();
+
+  const liked = form.dataset.liked === 'true';
+  let data;
+  try {
+    const resp = await fetch(`/messages/${form.dataset.messageId}/like`, {
+      method: liked ? 'DELETE' : 'POST',
+      headers: {'Accept': 'application/json'},
+      credentials: 'same-origin',
+    });
+    if (!resp.ok) throw new Error(resp.statusText);
+    data = await resp.json();
+  } catch (err) {
+    form.submit();
+    return;
+  }
+
+  form.dataset.liked = data.liked;
+
+  const button = form.querySelector('button');
+  button.classList.toggle('btn-primary', data.liked);
+  button.classList.toggle('btn-secondary', !data.liked);
+  button.title = `${data.likes} like${data.likes === 1 ? '' : 's'}`;
+});
@@ -0,0 +1,149 @@
+"""JSON API tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_api.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+from models import db, Message, User, Follows, Likes, HomeTimeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+
+class ApiTestCase(TestCase):
+    """Test the /api/v1 read endpoints."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.client = app.test_client()
+
+        self.u1 = User.signup("testuser", "test@test.com", "password", None)
+        self.u2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        self.messages = [
+            Message(text=f"warble {i}", user_id=self.u2.id,
+                    timestamp=start - timedelta(minutes=i))
+            for i in range(3)
+        ]
+        db.session.add_all(self.messages)
+        db.session.add(Follows(user_being_followed_id=self.u2.id,
+                               user_following_id=self.u1.id))
+        db.session.commit()
+
+        db.session.add(Likes(user_id=self.u1.id, message_id=self.messages[0].id))
+        HomeTimeline.rebuild([self.u1.id])
+        User.recount_stats()
+        db.session.commit()
+
+    def login(self, c, user):
+        with c.session_transaction() as sess:
+            sess[CURR_USER_KEY] = user.id
+
+    def test_user_detail(self):
+        """test that a user comes back without private fields"""
+
+        resp = self.client.get(f'/api/v1/users/{self.u2.id}')
+        data = resp.get_json()
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(data['username'], 'testuser2')
+        self.assertEqual(data['messages_count'], 3)
+        self.assertNotIn('password', data)
+        self.assertNotIn('email', data)
+
+    def test_batch_and_fields(self):
+        """test batch fetches keep the requested order and fields"""
+
+        ids = [m.id for m in reversed(self.messages)] + [999999]
+        resp = self.client.get(
+            '/api/v1/messages?ids=' + ','.join(map(str, ids)) +
+            '&fields=id,username')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.get_json()['items'], [
+            {'id': m.id, 'username': 'testuser2'} for m in reversed(self.messages)
+        ])
+
+        resp = self.client.get(f'/api/v1/users?ids={self.u2.id},{self.u1.id}&fields=username')
+        self.assertEqual(resp.get_json()['items'],
+                         [{'username': 'testuser2'}, {'username': 'testuser'}])
+
+    def test_bad_requests(self):
+        """test that bad ids, unknown fields and empty selections are rejected"""
+
+        self.assertEqual(self.client.get('/api/v1/users?ids=x').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/users').status_code, 400)
+        resp = self.client.get(f'/api/v1/users/{self.u1.id}?fields=password')
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn('password', resp.get_json()['error'])
+        self.assertEqual(
+            self.client.get(f'/api/v1/users/{self.u1.id}?fields=,').status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/v1/messages/1?fields=%20,,').status_code, 400)
+        self.assertEqual(self.client.get('/api/v1/users/999999').status_code, 404)
+
+    def test_timeline_pages(self):
+        """test the home timeline, one page at a time"""
+
+        self.assertEqual(self.client.get('/api/v1/timeline').status_code, 401)
+
+        with self.client as c:
+            self.login(c, self.u1)
+
+            first = c.get('/api/v1/timeline?fields=text&limit=2').get_json()
+            rest = c.get('/api/v1/timeline?fields=text&limit=2&before=' +
+                         first['next']).get_json()
+
+        self.assertEqual(first['items'], [{'text': 'warble 0'}, {'text': 'warble 1'}])
+        self.assertEqual(rest, {'items': [{'text': 'warble 2'}], 'next': None})
+
+    def test_likes_and_follows(self):
+        """test the likes, followers and following lists"""
+
+        resp = self.client.get(f'/api/v1/users/{self.u1.id}/likes?fields=id')
+        self.assertEqual(resp.get_json()['items'], [{'id': self.messages[0].id}])
+
+        with self.client as c:
+            self.login(c, self.u1)
+
+            followers = c.get(f'/api/v1/users/{self.u2.id}/followers?fields=username')
+            following = c.get(f'/api/v1/users/{self.u1.id}/following?fields=username')
+
+        self.assertEqual(followers.get_json()['items'], [{'username': 'testuser'}])
+        self.assertEqual(following.get_json()['items'], [{'username': 'testuser2'}])
+
+    def test_followers_by_follow_time(self):
+        """test that followers are paged newest follow first, like the site"""
+
+        u3 = User.signup("testuser3", "test3@test.com", "password", None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=self.u2.id,
+                               user_following_id=u3.id,
+                               created_at=datetime.utcnow() - timedelta(days=1)))
+        db.session.commit()
+
+        with self.client as c:
+            self.login(c, self.u1)
+
+            first = c.get(f'/api/v1/users/{self.u2.id}/followers'
+                          '?fields=username&limit=1').get_json()
+            rest = c.get(f'/api/v1/users/{self.u2.id}/followers'
+                         f'?fields=username&limit=1&before={first["next"]}').get_json()
+
+        # testuser3 has the larger id, but followed earlier
+        self.assertEqual(first['items'], [{'username': 'testuser'}])
+        self.assertEqual(rest['items'], [{'username': 'testuser3'}])
+        self.assertIsNone(rest['next'])
@@ -0,0 +1,130 @@
+"""ASGI serving mode tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_asgi.py
+
+
+import asyncio
+import os
+from unittest import TestCase, mock
+
+from starlette.testclient import TestClient
+
+from models import db, Message, User, Follows, HomeTimeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from asgi import app, flask_app
+from app import CURR_USER_KEY, user_cache
+
+db.create_all()
+
+flask_app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AsgiTestCase(TestCase):
+    """Test the async pages, and that the rest still reaches Flask."""
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        self.u1 = User.signup("testuser", "test@test.com", "password", None)
+        self.u2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=self.u2.id,
+                               user_following_id=self.u1.id))
+        db.session.add(Message(text="async warble", user_id=self.u2.id))
+        db.session.commit()
+        HomeTimeline.rebuild()
+        db.session.commit()
+
+        self.client = TestClient(app)
+        self.client.__enter__()
+
+    def tearDown(self):
+        self.client.__exit__(None, None, None)
+
+    def login(self, **session):
+        serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+        self.client.cookies.set('session', serializer.dumps(
+            {CURR_USER_KEY: self.u1.id, **session}))
+
+    def flask_get(self, path):
+        client = flask_app.test_client()
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.u1.id
+        return client.get(path)
+
+    def test_homepage(self):
+        """test the async homepage, logged out and in"""
+
+        resp = self.client.get('/')
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('Sign up', resp.text)
+
+        self.login()
+        resp = self.client.get('/')
+
+        self.assertIn('async warble', resp.text)
+        self.assertEqual(resp.text, self.flask_get('/').get_data(as_text=True))
+
+    def test_users_show(self):
+        """test that the async profile matches Flask's, ETag included"""
+
+        self.login()
+        resp = self.client.get(f'/users/{self.u2.id}')
+        flask_resp = self.flask_get(f'/users/{self.u2.id}')
+
+        self.assertEqual(resp.text, flask_resp.get_data(as_text=True))
+        self.assertIn('Unfollow', resp.text)
+        self.assertEqual(resp.headers['ETag'], flask_resp.headers['ETag'])
+
+        resp = self.client.get(f'/users/{self.u2.id}',
+                               headers={'If-None-Match': resp.headers['ETag']})
+        self.assertEqual(resp.status_code, 304)
+
+    def test_falls_back_to_flask(self):
+        """test that other pages, missing users and flashes go to Flask"""
+
+        self.assertEqual(self.client.get('/users/0').status_code, 404)
+        self.assertIn('testuser2', self.client.get('/users').text)
+
+        self.login()
+        self.assertEqual(self.client.get('/?before=bad').status_code, 400)
+
+        self.login(_flashes=[('success', 'Hello from Flask!')])
+        self.assertIn('Hello from Flask!', self.client.get('/').text)
+
+        resp = self.client.post('/login', data={'username': 'testuser',
+                                                'password': 'password'},
+                                follow_redirects=False)
+        self.assertEqual(resp.status_code, 302)
+
+    def test_async_pool_metrics(self):
+        """test that the async engine's pool shows up in /metrics"""
+
+        self.login()
+        self.client.get('/')
+        text = self.client.get('/metrics').text
+
+        self.assertIn('warbler_db_pool_wait_seconds_count{pool="async-primary"}', text)
+        self.assertIn('warbler_db_pool_size{pool="async-primary"} 5', text)
+
+    def test_user_cache_off_event_loop(self):
+        """test that the user cache isn't called on the event loop"""
+
+        def get(user_id):
+            with self.assertRaises(RuntimeError):
+                asyncio.get_running_loop()
+            calls.append(user_id)
+
+        calls = []
+        self.login()
+        with mock.patch.object(user_cache, 'get', get):
+            self.assertEqual(self.client.get('/').status_code, 200)
+
+        self.assertEqual(calls, [self.u1.id])
@@ -0,0 +1,89 @@
+"""Message card cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_fragment_cache.py
+
+
+from datetime import datetime
+from types import SimpleNamespace
+from unittest import TestCase
+
+from jinja2 import Environment, FileSystemLoader
+
+from fragment_cache import FragmentCache
+
+
+def make_message(message_id, user_id=1, text="hello", version=1):
+    user = SimpleNamespace(id=user_id, username=f"user{user_id}",
+                           image_url="/static/images/default-pic.png",
+                           version=version)
+    return SimpleNamespace(id=message_id, user_id=user_id, user=user,
+                           text=text, timestamp=datetime(2020, 1, 1))
+
+
+class FragmentCacheTestCase(TestCase):
+    """Test the rendered message card cache."""
+
+    def setUp(self):
+        self.env = Environment(loader=FileSystemLoader('templates'),
+                               autoescape=True)
+        self.cache = FragmentCache(maxsize=10)
+
+    def test_render_card(self):
+        """test that cards are rendered once, then served from the cache"""
+
+        html = self.cache.render_card(self.env, make_message(1))
+
+        self.assertIn('<p>hello</p>', html)
+        self.assertIn('@user1', html)
+
+        html = self.cache.render_card(self.env, make_message(1, text="changed"))
+        self.assertIn('<p>hello</p>', html)
+
+    def test_author_profile(self):
+        """test that a new username or picture renders the card again"""
+
+        self.cache.render_card(self.env, make_message(1))
+        msg = make_message(1, text="changed")
+        msg.user.username = "renamed"
+        html = self.cache.render_card(self.env, msg)
+
+        self.assertIn('@renamed', html)
+        self.assertIn('<p>changed</p>', html)
+
+    def test_author_counters(self):
+        """test that a version bump from a like or follow keeps the card"""
+
+        self.cache.render_card(self.env, make_message(1))
+        html = self.cache.render_card(self.env, make_message(1, text="changed",
+                                                             version=2))
+
+        self.assertIn('<p>hello</p>', html)
+
+    def test_invalidate(self):
+        """test that deleted messages and edited authors are dropped"""
+
+        self.cache.render_card(self.env, make_message(1, user_id=1))
+        self.cache.render_card(self.env, make_message(2, user_id=2))
+
+        self.cache.invalidate(1)
+        self.cache.invalidate_author(2)
+
+        for message_id, user_id in ((1, 1), (2, 2)):
+            html = self.cache.render_card(
+                self.env, make_message(message_id, user_id, text="fresh"))
+            self.assertIn('<p>fresh</p>', html)
+
+    def test_lru_eviction(self):
+        """test that the least recently used card is evicted"""
+
+        cache = FragmentCache(maxsize=2)
+        for message_id in (1, 2, 3):
+            cache.render_card(self.env, make_message(message_id))
+
+        html = cache.render_card(self.env, make_message(1, text="fresh"))
+        self.assertIn('<p>fresh</p>', html)
+
+        html = cache.render_card(self.env, make_message(3, text="fresh"))
+        self.assertIn('<p>hello</p>', html)
@@ -0,0 +1,221 @@
+"""Background job queue tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_jobs.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase, mock
+
+from models import db, Message, User, Follows, Likes, HomeTimeline
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+import jobs
+from jobs import Job, enqueue, run_pending
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class JobsTestCase(TestCase):
+    """Test queueing, batching and retrying jobs."""
+
+    def setUp(self):
+        Job.query.delete()
+        User.query.delete()
+        Message.query.delete()
+        db.session.commit()
+
+        self.u1 = User.signup("testuser", "test@test.com", "password", None)
+        self.u2 = User.signup("testuser2", "test2@test.com", "password", None)
+        db.session.commit()
+
+        self.calls = []
+        self.handlers = mock.patch.dict(jobs.HANDLERS)
+        self.handlers.start()
+
+    def tearDown(self):
+        self.handlers.stop()
+        db.session.rollback()
+
+    def test_batches_same_kind(self):
+        """test that due jobs of a kind are run together, then deleted"""
+
+        jobs.handler('record', batch_size=2)(self.calls.append)
+
+        for n in range(3):
+            enqueue('record', n=n)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), (3, 0))
+        self.assertEqual(self.calls, [[{'n': 0}, {'n': 1}], [{'n': 2}]])
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_failures_retry_then_stop(self):
+        """test that a bad job backs off, and is kept once out of attempts"""
+
+        def record(payloads):
+            if any(payload['n'] == 1 for payload in payloads):
+                raise ValueError("bad job")
+            self.calls.append(payloads)
+
+        jobs.handler('record', batch_size=10)(record)
+
+        enqueue('record', n=0)
+        enqueue('record', n=1)
+        db.session.commit()
+
+        self.assertEqual(run_pending(), (2, 1))
+        self.assertEqual(self.calls, [[{'n': 0}]])
+
+        job = Job.query.one()
+        self.assertEqual(job.attempts, 1)
+        self.assertEqual(job.last_error, "ValueError: bad job")
+        self.assertGreater(job.run_at, datetime.utcnow())
+
+        # not due yet
+        self.assertEqual(run_pending(), (0, 0))
+
+        job.attempts = job.max_attempts - 1
+        job.run_at = datetime.utcnow()
+        db.session.commit()
+
+        self.assertEqual(run_pending(), (1, 1))
+        self.assertIsNotNone(Job.query.one().failed_at)
+        self.assertEqual(run_pending(), (0, 0))
+
+    def test_unknown_kind(self):
+        """test that enqueueing a job nothing handles is refused"""
+
+        with self.assertRaises(ValueError):
+            enqueue('no such kind')
+
+    def test_fan_out(self):
+        """test that posting a message reaches followers via the queue"""
+
+        db.session.add(Follows(user_being_followed_id=self.u1.id,
+                               user_following_id=self.u2.id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+            c.post("/messages/new", data={"text": "queued warble"})
+
+        self.assertEqual(HomeTimeline.query.filter_by(user_id=self.u2.id).count(), 0)
+        self.assertEqual(Job.query.one().kind, 'fan_out')
+
+        run_pending()
+
+        self.assertEqual(HomeTimeline.query.filter_by(user_id=self.u2.id).count(), 1)
+
+    def test_delete_user(self):
+        """test that a deleted account is hidden, then purged in steps"""
+
+        db.session.add(Follows(user_being_followed_id=self.u1.id,
+                               user_following_id=self.u2.id))
+        User.adjust_counts(self.u1.id, followers_count=1)
+        User.adjust_counts(self.u2.id, following_count=1)
+        msgs = [Message(text=f"warble {n}", user_id=self.u2.id) for n in range(3)]
+        db.session.add_all(msgs)
+        db.session.flush()
+        db.session.add_all(Likes(user_id=self.u1.id, message_id=msg.id)
+                           for msg in msgs)
+        User.adjust_counts(self.u1.id, likes_count=3)
+        db.session.commit()
+        u2_id = self.u2.id
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+            c.post('/users/delete')
+
+            self.assertEqual(c.get(f'/users/{u2_id}').status_code, 404)
+            self.assertEqual(c.get(f'/messages/{msgs[0].id}').status_code, 404)
+            self.assertFalse(User.authenticate("testuser2", "password"))
+
+        with mock.patch('models.PURGE_BATCH_SIZE', 2):
+            self.assertEqual(run_pending(max_batches=1), (1, 0))
+            db.session.expire_all()
+
+            # the likes of the first two messages are gone, the messages not yet
+            self.assertEqual(Message.query.filter_by(user_id=u2_id).count(), 3)
+            self.assertEqual(self.u1.likes_count, 1)
+            self.assertEqual(Job.query.one().kind, 'delete_user')
+
+            run_pending()
+
+        db.session.expire_all()
+
+        self.assertIsNone(db.session.get(User, u2_id))
+        self.assertEqual(self.u1.followers_count, 0)
+        self.assertEqual(self.u1.likes_count, 0)
+        self.assertEqual(Job.query.count(), 0)
+
+    def test_deleted_account_leaves_likes_page(self):
+        """test that a deleted account's messages leave likers' likes pages"""
+
+        msg = Message(text="soon gone", user_id=self.u2.id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(Likes(user_id=self.u1.id, message_id=msg.id))
+        db.session.commit()
+
+        with app.test_client() as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u2.id
+            c.post('/users/delete')
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.u1.id
+            resp = c.get(f'/user/{self.u1.id}/likes')
+
+        # hidden at once, before the purge job has run
+        self.assertEqual(Job.query.one().kind, 'delete_user')
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotIn('soon gone', resp.get_data(as_text=True))
+
+    def test_purge_bounds_cascade(self):
+        """test that a purge step never deletes more than PURGE_BATCH_SIZE rows"""
+
+        fans = [self.u2] + [User.signup(f"fan{n}", f"fan{n}@test.com", "password", None)
+                            for n in range(2)]
+        db.session.flush()
+        msg = Message(text="popular warble", user_id=self.u1.id)
+        db.session.add(msg)
+        db.session.flush()
+        for fan in fans:
+            db.session.add(Follows(user_being_followed_id=self.u1.id,
+                                   user_following_id=fan.id))
+            db.session.add(Likes(user_id=fan.id, message_id=msg.id))
+            db.session.add(HomeTimeline(user_id=fan.id, message_id=msg.id,
+                                        author_id=self.u1.id,
+                                        timestamp=msg.timestamp))
+        User.adjust_counts([fan.id for fan in fans], following_count=1, likes_count=1)
+        self.u1.hide()
+        db.session.commit()
+
+        def rows():
+            return (HomeTimeline.query.count() + Likes.query.count()
+                    + Message.query.count() + Follows.query.count())
+
+        with mock.patch('models.PURGE_BATCH_SIZE', 2):
+            before, steps = rows(), 0
+            while User.purge(self.u1.id):
+                db.session.commit()
+                self.assertLessEqual(before - rows(), 2)
+                before, steps = rows(), steps + 1
+            db.session.commit()
+
+        # 3 timeline rows, 3 likes, the message and 3 follows, 2 at a time
+        self.assertEqual(steps, 7)
+        self.assertEqual(rows(), 0)
+        self.assertIsNone(db.session.get(User, self.u1.id))
+        for fan in fans:
+            db.session.refresh(fan)
+            self.assertEqual((fan.following_count, fan.likes_count), (0, 0))
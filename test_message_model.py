@@ -1,6 +1,9 @@
 import os
+import time
 from unittest import TestCase
 
+from sqlalchemy.exc import IntegrityError
+
 from models import db, Message, User, Likes
 
 # BEFORE we import our app, let's set an environmental variable
@@ -119,4 +122,33 @@ class MessageModelTestCase(TestCase):
         self.assertEqual(len(self.user.messages), 2)
 
 
-       
\ No newline at end of file
+       
+    def test_timestamp_per_message(self):
+        """test that each message is stamped when it is created"""
+
+        m1 = Message(text='first', user_id=self.user.id)
+        db.session.add(m1)
+        db.session.commit()
+
+        time.sleep(0.01)
+
+        m2 = Message(text='second', user_id=self.user.id)
+        db.session.add(m2)
+        db.session.commit()
+
+        self.assertLess(m1.timestamp, m2.timestamp)
+
+    def test_duplicate_like(self):
+        """test that a user can't like the same message twice"""
+
+        m = Message(text='test message', user_id=self.user.id)
+        db.session.add(m)
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=self.user.id, message_id=m.id),
+                            Likes(user_id=self.user.id, message_id=m.id)])
+
+        with self.assertRaises(IntegrityError):
+            db.session.commit()
+
+        db.session.rollback()
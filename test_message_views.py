@@ -20,7 +20,8 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
 
 # Now we can import app
 
-from app import app, CURR_USER_KEY
+from app import app, fragment_cache, CURR_USER_KEY
+from jobs import run_pending
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -86,6 +87,30 @@ class MessageViewTestCase(TestCase):
             msg = Message.query.all()
             self.assertEqual(msg[len(msg) - 1].text, "Hello")
     
+    def test_add_message_fans_out(self):
+        """Does a new message show up on a follower's home page?"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            c.post(f"/users/follow/{self.testuser.id}")
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            c.post("/messages/new", data={"text": "Fresh warble"})
+            run_pending()
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            resp = c.get("/")
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<p>Fresh warble</p>', html)
+
     def test_add_message_get(self):
         """user add message form"""
 
@@ -120,6 +145,45 @@ class MessageViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('<p class="single-message">test message</p>', html)
 
+    def test_message_get_not_modified(self):
+        """test that a repeat message view is answered with a 304"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            etag = c.get(f"/messages/{self.testmsg.id}").headers['ETag']
+            resp = c.get(f"/messages/{self.testmsg.id}",
+                         headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+
+            # a pending flash has to be rendered, so the page is sent again
+            with c.session_transaction() as sess:
+                sess['_flashes'] = [('success', 'Hello!')]
+
+            resp = c.get(f"/messages/{self.testmsg.id}",
+                         headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('Hello!', resp.get_data(as_text=True))
+
+    def test_card_survives_follow_and_like(self):
+        """test that following the author and liking keep the cached card"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            c.get(f"/users/{self.testuser.id}")
+            card = fragment_cache._entries[self.testmsg.id]
+
+            c.post(f"/users/follow/{self.testuser.id}")
+            c.post(f"/users/add_like/{self.testmsg.id}")
+            c.get(f"/users/{self.testuser.id}")
+
+            self.assertIs(fragment_cache._entries[self.testmsg.id], card)
+
     def test_delete_message(self):
         """test user delete"""
 
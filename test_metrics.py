@@ -0,0 +1,180 @@
+"""Metrics tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_metrics.py
+
+
+import os
+import sqlite3
+from unittest import TestCase
+
+from flask import g
+from sqlalchemy.exc import ProgrammingError, TimeoutError
+
+from models import db, User
+from metrics import Registry, registry
+from db_pool import TimedQueuePool, engine_options
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, CURR_USER_KEY
+
+db.create_all()
+
+# Don't have WTForms use CSRF at all, since it's a pain to test
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class RegistryTestCase(TestCase):
+    """Test the Prometheus text rendering."""
+
+    def test_render(self):
+        """test counters and cumulative histogram buckets"""
+
+        registry = Registry()
+        registry.counter('hits_total', "Hits.")
+        registry.histogram('latency_seconds', "Latency.", buckets=(0.1, 1.0))
+
+        registry.inc('hits_total', {'endpoint': 'home'})
+        registry.inc('hits_total', {'endpoint': 'home'}, 2)
+        registry.observe('latency_seconds', {'endpoint': 'home'}, 0.05)
+        registry.observe('latency_seconds', {'endpoint': 'home'}, 0.5)
+        registry.observe('latency_seconds', {'endpoint': 'home'}, 5)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE hits_total counter', text)
+        self.assertIn('hits_total{endpoint="home"} 3', text)
+        self.assertIn('latency_seconds_bucket{endpoint="home",le="0.1"} 1', text)
+        self.assertIn('latency_seconds_bucket{endpoint="home",le="1.0"} 2', text)
+        self.assertIn('latency_seconds_bucket{endpoint="home",le="+Inf"} 3', text)
+        self.assertIn('latency_seconds_count{endpoint="home"} 3', text)
+
+    def test_render_gauge(self):
+        """test that gauges show their latest value"""
+
+        registry = Registry()
+        registry.gauge('in_use', "In use.")
+        registry.set('in_use', {'pool': 'primary'}, 3)
+        registry.set('in_use', {'pool': 'primary'}, 1)
+
+        text = registry.render()
+
+        self.assertIn('# TYPE in_use gauge', text)
+        self.assertIn('in_use{pool="primary"} 1', text)
+
+
+class PoolTestCase(TestCase):
+    """Test the instrumented connection pool."""
+
+    def test_checkout_timeout(self):
+        """test that waits and timeouts are recorded"""
+
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'),
+                              pool_size=1, max_overflow=0, timeout=0.01)
+        pool.metrics_label = 'test-pool'
+
+        conn = pool.connect()
+        with self.assertRaises(TimeoutError):
+            pool.connect()
+        conn.close()
+
+        text = registry.render()
+        self.assertIn('warbler_db_pool_timeouts_total{pool="test-pool"} 1', text)
+        self.assertIn('warbler_db_pool_wait_seconds_count{pool="test-pool"} 2', text)
+        self.assertEqual(pool.recreate().metrics_label, 'test-pool')
+
+    def test_pgbouncer_options(self):
+        """test that PgBouncer mode turns off prepared statements where used"""
+
+        asyncpg = engine_options('postgresql+asyncpg:///warbler', pgbouncer=True)
+        psycopg2 = engine_options('postgresql:///warbler', pgbouncer=True)
+
+        self.assertEqual(asyncpg['connect_args']['statement_cache_size'], 0)
+        self.assertEqual(psycopg2['connect_args'], {})
+        self.assertNotIn('connect_args', engine_options('postgresql:///warbler'))
+
+
+class MetricsViewTestCase(TestCase):
+    """Test the /metrics endpoint."""
+
+    def setUp(self):
+        User.query.delete()
+
+        self.testuser = User.signup(username="testuser",
+                                    email="test@test.com",
+                                    password="testuser",
+                                    image_url=None)
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def test_metrics(self):
+        """test that requests, SQL, templates and bcrypt are recorded"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            # the server closes each response; that's when it's recorded
+            c.get(f"/users/{self.testuser.id}").close()
+            c.post("/login", data={"username": "testuser",
+                                   "password": "testuser"}).close()
+
+            resp = c.get("/metrics")
+            text = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertTrue(resp.content_type.startswith('text/plain'))
+            self.assertIn('warbler_requests_total{endpoint="users_show",method="GET",status="200"}', text)
+            self.assertIn('warbler_sql_queries_total{endpoint="users_show"}', text)
+            self.assertIn('warbler_template_render_seconds_count{template="users/show.html"}', text)
+            self.assertIn('warbler_bcrypt_duration_seconds_count{operation="check"}', text)
+            self.assertIn('warbler_db_pool_wait_seconds_count{pool="primary"}', text)
+            self.assertIn('warbler_db_pool_size{pool="primary"} 5', text)
+            self.assertIn('warbler_db_pool_saturation{pool="primary"}', text)
+
+    def test_streamed_page_recorded_on_close(self):
+        """test that a streamed page is recorded once it has been sent"""
+
+        def sql_queries(endpoint):
+            text = registry.render()
+            prefix = f'warbler_sql_queries_total{{endpoint="{endpoint}"}} '
+            for line in text.splitlines():
+                if line.startswith(prefix):
+                    return int(line[len(prefix):])
+            return 0
+
+        before = sql_queries('list_users')
+        resp = self.client.get("/users")
+        self.assertEqual(sql_queries('list_users'), before)
+
+        resp.get_data()
+        resp.close()
+        self.assertGreater(sql_queries('list_users'), before)
+
+    def test_failed_query_timer(self):
+        """test that a failed statement leaves no timer behind"""
+
+        with app.test_request_context():
+            app.preprocess_request()
+
+            with self.assertRaises(ProgrammingError):
+                db.session.execute(db.text("SELECT no_such_column"))
+            db.session.rollback()
+            db.session.execute(db.text("SELECT 1"))
+
+            self.assertEqual(g.metrics_sql_count, 1)
+            connection = db.session.connection()
+            self.assertFalse([key for key in connection.info
+                              if key.startswith('metrics')])
@@ -0,0 +1,148 @@
+"""Schema migration tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_migrations.py
+
+
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
+
+from sqlalchemy.dialects import sqlite
+from sqlalchemy.schema import CreateTable
+
+from models import db, User, Message, Follows, HomeTimeline, Likes
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app
+
+import migrations
+
+db.create_all()
+
+
+class MigrationsTestCase(TestCase):
+    """Test the migration runner against the test database."""
+
+    def setUp(self):
+        Message.query.delete()
+        User.query.delete()
+        db.session.commit()
+
+    def test_upgrade_stamped_database(self):
+        """test that an up-to-date database has nothing to apply"""
+
+        migrations.stamp()
+
+        self.assertEqual(migrations.upgrade(echo=lambda line: None), 0)
+        self.assertEqual(migrations.applied_versions(),
+                         {m.version for m in migrations.MIGRATIONS})
+
+    def test_steps_rerun(self):
+        """test that a migration can be applied again after a failure"""
+
+        migrations.MIGRATIONS[-1].apply()
+        migrations.MIGRATIONS[-1].apply()
+
+    def test_schema_portable(self):
+        """test that the schema's DDL also compiles for SQLite"""
+
+        dialect = sqlite.dialect()
+        for table in [*db.metadata.sorted_tables, migrations.schema_version]:
+            ddl = str(CreateTable(table).compile(dialect=dialect))
+            self.assertNotIn("time zone", ddl)
+
+    def test_in_batches(self):
+        """test that backfills cover every row, one batch at a time"""
+
+        users = [User(username=f"user{i}", email=f"user{i}@test.com",
+                      password="HASHED_PASSWORD") for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add_all([Message(text="hi", user_id=u.id) for u in users])
+        db.session.commit()
+
+        with mock.patch.object(migrations, 'BATCH_SIZE', 2):
+            migrations.in_batches('users', migrations.RECOUNT_USERS)()
+
+        db.session.expire_all()
+        self.assertEqual([u.messages_count for u in User.query.all()],
+                         [1] * 5)
+
+    def test_dedupe_likes(self):
+        """test that duplicate likes are removed across batches of likes"""
+
+        user = User(username="user0", email="user0@test.com",
+                    password="HASHED_PASSWORD", likes_count=5)
+        db.session.add(user)
+        db.session.commit()
+        first, second = [Message(text="hi", user_id=user.id) for _ in range(2)]
+        db.session.add_all([first, second])
+        db.session.commit()
+
+        db.session.execute(db.text(
+            "ALTER TABLE likes DROP CONSTRAINT uq_likes_user_message"))
+        try:
+            db.session.add_all([Likes(user_id=user.id, message_id=msg.id)
+                                for msg in (first, first, second, first, second)])
+            db.session.commit()
+
+            with mock.patch.object(migrations, 'BATCH_SIZE', 2):
+                migrations.in_batches('likes', migrations.DEDUPE_LIKES)()
+
+            self.assertEqual(
+                sorted(like.message_id for like in Likes.query.all()),
+                sorted([first.id, second.id]))
+            db.session.expire_all()
+            self.assertEqual(user.likes_count, 2)
+        finally:
+            db.session.rollback()
+            Likes.query.delete()
+            db.session.execute(db.text(
+                "ALTER TABLE likes ADD CONSTRAINT uq_likes_user_message"
+                " UNIQUE (user_id, message_id)"))
+            db.session.commit()
+
+    def make_follow_with_history(self, count):
+        author, follower = [User(username=f"user{i}", email=f"user{i}@test.com",
+                                 password="HASHED_PASSWORD") for i in range(2)]
+        db.session.add_all([author, follower])
+        db.session.commit()
+
+        start = datetime(2020, 1, 1)
+        messages = [Message(text=f"warble {n}", user_id=author.id,
+                            timestamp=start + timedelta(minutes=n))
+                    for n in range(count)]
+        db.session.add_all(messages)
+        db.session.add(Follows(user_being_followed_id=author.id,
+                               user_following_id=follower.id))
+        db.session.commit()
+
+        return follower, [msg.id for msg in messages]
+
+    def timeline_ids(self, user):
+        return {row.message_id
+                for row in HomeTimeline.query.filter_by(user_id=user.id)}
+
+    def test_rebuild_home_timelines_capped(self):
+        """test that the timeline backfill takes only recent messages per follow"""
+
+        follower, message_ids = self.make_follow_with_history(3)
+
+        migrations.in_batches('users', migrations.REBUILD_HOME_TIMELINES,
+                              limit=2)()
+
+        self.assertEqual(self.timeline_ids(follower), set(message_ids[1:]))
+
+    def test_model_rebuild_capped(self):
+        """test that HomeTimeline.rebuild is capped like a follow backfill"""
+
+        follower, message_ids = self.make_follow_with_history(3)
+
+        with mock.patch('models.TIMELINE_BACKFILL_LIMIT', 2):
+            HomeTimeline.rebuild([follower.id])
+            db.session.commit()
+
+        self.assertEqual(self.timeline_ids(follower), set(message_ids[1:]))
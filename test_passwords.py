@@ -0,0 +1,70 @@
+"""Password hashing pool tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_passwords.py
+
+
+import threading
+from unittest import TestCase
+
+from flask import Flask
+from flask_bcrypt import Bcrypt
+
+from passwords import PasswordHasher, PasswordHasherBusy
+
+
+def make_hasher(**config):
+    app = Flask(__name__)
+    app.config.update(BCRYPT_LOG_ROUNDS=4, **config)
+
+    hasher = PasswordHasher(Bcrypt())
+    hasher.init_app(app)
+    return hasher
+
+
+class PasswordHasherTestCase(TestCase):
+    """Test the bounded bcrypt pool."""
+
+    def test_hash_and_check(self):
+        """test that hashes use the configured cost and check out"""
+
+        hasher = make_hasher()
+        pw_hash = hasher.hash("secret")
+
+        self.assertTrue(pw_hash.startswith("$2b$04$"))
+        self.assertTrue(hasher.check(pw_hash, "secret"))
+        self.assertFalse(hasher.check(pw_hash, "wrong"))
+
+    def test_needs_rehash(self):
+        """test that only hashes at another cost need rehashing"""
+
+        hasher = make_hasher()
+
+        self.assertFalse(hasher.needs_rehash(hasher.hash("secret")))
+        self.assertTrue(hasher.needs_rehash(
+            "$2b$12$Q1PUFjhN/AWRQ21LbGYvjeLpZZB6lfZ1BPwifHALGO6oIbyC3CmJe"))
+
+    def test_busy(self):
+        """test that work beyond the pool and queue is refused"""
+
+        hasher = make_hasher(BCRYPT_WORKERS=1, BCRYPT_QUEUE_LIMIT=0)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait(5)
+
+        thread = threading.Thread(target=hasher._run, args=(block,))
+        thread.start()
+        started.wait(5)
+
+        try:
+            with self.assertRaises(PasswordHasherBusy):
+                hasher.hash("secret")
+        finally:
+            release.set()
+            thread.join()
+
+        self.assertTrue(hasher.check(hasher.hash("secret"), "secret"))
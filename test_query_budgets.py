@@ -0,0 +1,101 @@
+"""Query budget tests: each page must render in a fixed number of queries."""
+
+# run these tests like:
+#
+#    python -m unittest test_query_budgets.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, User, Message, Follows, Likes, HomeTimeline
+from query_budget import QueryBudgetMixin
+
+# BEFORE we import our app, let's set an environmental variable
+# to use a different database for tests (we need to do this
+# before we import our app, since that will have already
+# connected to the database
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+
+# Now we can import app
+
+from app import app, user_cache, CURR_USER_KEY
+
+db.create_all()
+
+NUM_USERS = 20
+NUM_MESSAGES = 30
+
+
+class QueryBudgetTestCase(QueryBudgetMixin, TestCase):
+    """Page query counts must not grow with the number of rows shown."""
+
+    def setUp(self):
+        """Create users who all follow each other and like each other's messages."""
+
+        User.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+
+        users = [
+            User(email=f"test{i}@test.com", username=f"testuser{i}",
+                 password="HASHED_PASSWORD")
+            for i in range(NUM_USERS)
+        ]
+        db.session.add_all(users)
+        db.session.commit()
+
+        messages = [
+            Message(text=f"message {i}", user_id=users[i % NUM_USERS].id)
+            for i in range(NUM_MESSAGES)
+        ]
+        db.session.add_all(messages)
+        db.session.add_all([
+            Follows(user_being_followed_id=followed.id, user_following_id=follower.id)
+            for followed in users for follower in users if followed != follower
+        ])
+        db.session.commit()
+
+        db.session.add_all([Likes(user_id=users[0].id, message_id=msg.id)
+                            for msg in messages])
+        HomeTimeline.rebuild()
+        User.recount_stats()
+        db.session.commit()
+
+        self.user_id = users[0].id
+        self.other_id = users[1].id
+        self.message_id = messages[1].id
+        user_cache.invalidate(self.user_id)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user_id
+
+    def assertPageWithinBudget(self, url, budget):
+        with self.assertMaxQueries(budget):
+            resp = self.client.get(url)
+
+        self.assertEqual(resp.status_code, 200)
+
+    def test_homepage(self):
+        self.assertPageWithinBudget("/", 3)
+
+    def test_users_show(self):
+        self.assertPageWithinBudget(f"/users/{self.other_id}", 4)
+
+    def test_show_likes(self):
+        self.assertPageWithinBudget(f"/user/{self.user_id}/likes", 3)
+
+    def test_messages_show(self):
+        self.assertPageWithinBudget(f"/messages/{self.message_id}", 3)
+
+    def test_show_following(self):
+        self.assertPageWithinBudget(f"/users/{self.other_id}/following", 5)
+
+    def test_users_followers(self):
+        self.assertPageWithinBudget(f"/users/{self.other_id}/followers", 5)
+
+    def test_list_users(self):
+        self.assertPageWithinBudget("/users", 3)
@@ -0,0 +1,111 @@
+"""Read replica routing tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_replicas.py
+
+
+import os
+from time import time
+from unittest import TestCase, mock
+
+from sqlalchemy import create_engine, event
+
+from models import db, Message, User
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler-test"
+
+from app import app, CURR_USER_KEY
+from replicas import REPLICA_BIND_PREFIX, STICKY_KEY
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ReplicaRoutingTestCase(TestCase):
+    """Test which engine pages read from."""
+
+    @classmethod
+    def setUpClass(cls):
+        # The "replica" is a second engine on the test database, which is
+        # enough to see which engine each query goes to. It's added here
+        # rather than through DATABASE_REPLICA_URLS, which only counts if
+        # this module is the first to import the app.
+        cls.replica = create_engine(db.engine.url)
+        cls.engines = mock.patch.dict(
+            db.engines, {f'{REPLICA_BIND_PREFIX}0': cls.replica})
+        cls.engines.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.engines.stop()
+        cls.replica.dispose()
+
+    def setUp(self):
+        User.query.delete()
+        Message.query.delete()
+
+        self.user = User.signup(username="testuser",
+                                email="test@test.com",
+                                password="testuser",
+                                image_url=None)
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.queries = {'primary': 0, 'replica': 0}
+        self.listeners = []
+
+        for name, engine in (('primary', db.engines[None]),
+                             ('replica', self.replica)):
+            def count(*args, name=name):
+                self.queries[name] += 1
+
+            event.listen(engine, 'before_cursor_execute', count)
+            self.listeners.append((engine, count))
+
+    def tearDown(self):
+        for engine, count in self.listeners:
+            event.remove(engine, 'before_cursor_execute', count)
+
+    def login(self, client):
+        with client.session_transaction() as sess:
+            sess[CURR_USER_KEY] = self.user.id
+
+    def test_read_page_uses_replica(self):
+        """test that a read-only page queries the replica"""
+
+        resp = self.client.get(f'/users/{self.user.id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertGreater(self.queries['replica'], 0)
+
+    def test_other_pages_use_primary(self):
+        """test that pages not marked for replicas stay on the primary"""
+
+        with self.client as c:
+            self.login(c)
+            c.get(f'/users/{self.user.id}/following')
+
+        self.assertEqual(self.queries['replica'], 0)
+        self.assertGreater(self.queries['primary'], 0)
+
+    def test_writes_stick_to_primary(self):
+        """test that a client reads from the primary right after writing"""
+
+        with self.client as c:
+            self.login(c)
+            c.post('/messages/new', data={'text': 'fresh warble'})
+
+            resp = c.get(f'/users/{self.user.id}')
+            self.assertIn('fresh warble', resp.get_data(as_text=True))
+            self.assertEqual(self.queries['replica'], 0)
+
+            with c.session_transaction() as sess:
+                sess[STICKY_KEY] = time() - 1
+
+            c.get(f'/users/{self.user.id}')
+            self.assertGreater(self.queries['replica'], 0)
+
+            with c.session_transaction() as sess:
+                self.assertNotIn(STICKY_KEY, sess)
@@ -0,0 +1,106 @@
+"""User cache tests."""
+
+# run these tests like:
+#
+#    python -m unittest test_user_cache.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+from user_cache import (LocalUserCache, SocketUserCache, UserCacheServer,
+                        UserSnapshot)
+
+
+def make_snapshot(user_id, username="testuser"):
+    return UserSnapshot(
+        id=user_id,
+        username=username,
+        email=f"{username}@test.com",
+        image_url="/static/images/default-pic.png",
+        header_image_url="/static/images/warbler-hero.jpg",
+        bio=None,
+        location=None,
+        messages_count=0,
+        following_count=0,
+        followers_count=0,
+        likes_count=0,
+        version=1,
+    )
+
+
+class LocalUserCacheTestCase(TestCase):
+    """Test the in-process user cache."""
+
+    def test_get_set_invalidate(self):
+        """test that cached snapshots come back until invalidated"""
+
+        cache = LocalUserCache(maxsize=10, ttl=30)
+        cache.set(make_snapshot(1))
+
+        self.assertEqual(cache.get(1).username, "testuser")
+        self.assertIsNone(cache.get(2))
+
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_ttl(self):
+        """test that snapshots expire"""
+
+        cache = LocalUserCache(maxsize=10, ttl=0.01)
+        cache.set(make_snapshot(1))
+        time.sleep(0.02)
+
+        self.assertIsNone(cache.get(1))
+
+    def test_lru_eviction(self):
+        """test that the least recently used snapshot is evicted"""
+
+        cache = LocalUserCache(maxsize=2, ttl=30)
+        cache.set(make_snapshot(1))
+        cache.set(make_snapshot(2))
+        cache.get(1)
+        cache.set(make_snapshot(3))
+
+        self.assertIsNotNone(cache.get(1))
+        self.assertIsNone(cache.get(2))
+        self.assertIsNotNone(cache.get(3))
+
+
+class SocketUserCacheTestCase(TestCase):
+    """Test the shared cache server and its client."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, "users.sock")
+        self.server = UserCacheServer(self.path, ttl=30)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tmpdir.cleanup()
+
+    def test_round_trip(self):
+        """test that snapshots survive a trip through the server"""
+
+        cache = SocketUserCache(self.path)
+        cache.set(make_snapshot(1, "catman"))
+
+        snapshot = cache.get(1)
+        self.assertEqual(snapshot.username, "catman")
+        self.assertEqual(snapshot.to_dict(), make_snapshot(1, "catman").to_dict())
+
+        cache.invalidate(1)
+        self.assertIsNone(cache.get(1))
+
+    def test_server_down_is_a_miss(self):
+        """test that an unreachable server acts like an empty cache"""
+
+        cache = SocketUserCache(os.path.join(self.tmpdir.name, "missing.sock"))
+        cache.set(make_snapshot(1))
+
+        self.assertIsNone(cache.get(1))
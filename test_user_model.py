@@ -8,7 +8,7 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Follows
+from models import db, hasher, User, Message, Follows, Likes
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -148,6 +148,120 @@ class UserModelTestCase(TestCase):
         self.assertEqual(len(u1.followers), 0)
 
 
+    def test_follow_state_checks(self):
+        """test is_following/is_followed_by and the batch id lookups"""
+
+        u1 = User(
+            email="test@test.com",
+            username="testuser1",
+            password="HASHED_PASSWORD"
+        )
+        u2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD"
+        )
+        u3 = User(
+            email="test3@test.com",
+            username="testuser3",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=u2.id, user_following_id=u1.id))
+        db.session.commit()
+
+        self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u1.is_following(u3))
+        self.assertTrue(u2.is_followed_by(u1))
+        self.assertFalse(u1.is_followed_by(u2))
+        self.assertEqual(u1.following_ids_among([u2.id, u3.id]), {u2.id})
+        self.assertEqual(u2.follower_ids_among([u1.id, u3.id]), {u1.id})
+        self.assertEqual(u1.following_ids_among([]), set())
+
+    def test_liked_ids_among(self):
+        """test that liked_ids_among only returns liked message ids"""
+
+        u = User(
+            email="test@test.com",
+            username="testuser",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add(u)
+        db.session.commit()
+
+        m1 = Message(text="liked", user_id=u.id)
+        m2 = Message(text="not liked", user_id=u.id)
+        db.session.add_all([m1, m2])
+        db.session.commit()
+
+        db.session.add(Likes(user_id=u.id, message_id=m1.id))
+        db.session.commit()
+
+        self.assertEqual(u.liked_ids_among([m1.id, m2.id]), {m1.id})
+        self.assertEqual(u.liked_ids_among([]), set())
+
+    def test_recount_stats(self):
+        """test that recount_stats rebuilds the counter columns"""
+
+        u1 = User(
+            email="test@test.com",
+            username="testuser1",
+            password="HASHED_PASSWORD"
+        )
+        u2 = User(
+            email="test2@test.com",
+            username="testuser2",
+            password="HASHED_PASSWORD"
+        )
+        db.session.add_all([u1, u2])
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=u1.id, user_following_id=u2.id),
+            Message(text="one", user_id=u1.id),
+            Message(text="two", user_id=u1.id),
+        ])
+        User.recount_stats()
+        db.session.commit()
+
+        db.session.refresh(u1)
+        db.session.refresh(u2)
+        self.assertEqual(u1.messages_count, 2)
+        self.assertEqual(u1.followers_count, 1)
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.following_count, 1)
+        self.assertEqual(u2.messages_count, 0)
+
+    def test_search_ranking(self):
+        """test that search matches bio/location and ranks username prefixes first"""
+
+        db.session.add_all([
+            User(email="a@test.com", username="birdwatcher",
+                 password="HASHED_PASSWORD", bio="I love to warble"),
+            User(email="b@test.com", username="warbler_fan",
+                 password="HASHED_PASSWORD"),
+            User(email="c@test.com", username="someone",
+                 password="HASHED_PASSWORD", location="Warbleton"),
+            User(email="d@test.com", username="nobody",
+                 password="HASHED_PASSWORD"),
+        ])
+        db.session.commit()
+
+        users, has_more = User.search("warb", page=1, per_page=10)
+        usernames = [u.username for u in users]
+
+        self.assertEqual(usernames[0], "warbler_fan")
+        self.assertEqual(set(usernames), {"warbler_fan", "birdwatcher", "someone"})
+        self.assertFalse(has_more)
+
+        users, has_more = User.search("warb", page=1, per_page=2)
+        self.assertEqual(len(users), 2)
+        self.assertTrue(has_more)
+
+        self.assertEqual(User.search("!!", page=1, per_page=10), ([], False))
+
     def test_user_model_signup(self):
         """Does basic model work?"""
 
@@ -209,6 +323,34 @@ class UserModelTestCase(TestCase):
 
         self.assertEqual(u,u2)
     
+    def test_user_authenticate_rehashes(self):
+        """test that a password at another cost is rehashed on login"""
+
+        rounds = hasher.rounds
+        hasher.rounds = 5
+        try:
+            u = User.signup(
+                email="test@test.com",
+                username="testuser",
+                password="HASHED_PASSWORD",
+                image_url="/static/images/default-pic.png"
+            )
+            db.session.commit()
+            self.assertTrue(u.password.startswith("$2b$05$"))
+
+            hasher.rounds = 4
+            u2 = User.authenticate(
+                username="testuser",
+                password="HASHED_PASSWORD"
+            )
+            db.session.commit()
+        finally:
+            hasher.rounds = rounds
+
+        self.assertEqual(u, u2)
+        self.assertTrue(u2.password.startswith("$2b$04$"))
+        self.assertTrue(User.authenticate("testuser", "HASHED_PASSWORD"))
+
     def test_user_authenticate_incorrect_username(self):
         """test if authenticator returns correct user"""
 
@@ -2,9 +2,11 @@
 
 
 import os
-from unittest import TestCase
+import re
+from datetime import datetime, timedelta
+from unittest import TestCase, mock
 
-from models import db, connect_db, Message, User, Follows
+from models import db, connect_db, Message, User, Follows, HomeTimeline
 
 # BEFORE we import our app, let's set an environmental variable
 # to use a different database for tests (we need to do this
@@ -113,6 +115,163 @@ class UserViewTestCaseLoggedIn(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('<p>@testuser</p>', html)
            
+    def test_like_json(self):
+        """test that liking and unliking through JSON is idempotent"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            for _ in range(2):
+                resp = c.post(f"/messages/{self.testmsg.id}/like")
+
+                self.assertEqual(resp.status_code, 200)
+                self.assertEqual(resp.get_json(), {
+                    'message_id': self.testmsg.id, 'liked': True, 'likes': 1})
+                self.assertEqual(User.query.get(self.testuser2.id).likes_count, 1)
+
+            for _ in range(2):
+                resp = c.delete(f"/messages/{self.testmsg.id}/like")
+
+                self.assertEqual(resp.get_json(), {
+                    'message_id': self.testmsg.id, 'liked': False, 'likes': 0})
+                self.assertEqual(User.query.get(self.testuser2.id).likes_count, 0)
+
+    def test_like_json_errors(self):
+        """test that the like endpoint needs a login and a real message"""
+
+        resp = self.client.post(f"/messages/{self.testmsg.id}/like")
+        self.assertEqual(resp.status_code, 401)
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post("/messages/999999/like")
+            self.assertEqual(resp.status_code, 404)
+
+    def test_remove_like_not_liked(self):
+        """test that removing a like that doesn't exist is harmless"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f"/users/{self.testuser.id}/add_like/{self.testmsg.id}")
+
+            self.assertEqual(resp.status_code, 302)
+            self.assertEqual(User.query.get(self.testuser.id).likes_count, 0)
+
+    def test_users_show_pagination(self):
+        """test that profile messages page with a load more cursor"""
+
+        start = datetime(2020, 1, 1)
+        db.session.add_all([
+            Message(text=f"warble {i}", user_id=self.testuser.id,
+                    timestamp=start - timedelta(minutes=i))
+            for i in range(1, 101)
+        ])
+        db.session.commit()
+
+        with self.client as c:
+            resp = c.get(f'/users/{self.testuser.id}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<p>warble 99</p>', html)
+            self.assertNotIn('<p>warble 100</p>', html)
+
+            cursor = re.search(r'href="\?before=([^"]+)"', html).group(1)
+            resp = c.get(f'/users/{self.testuser.id}?before={cursor}')
+            html = resp.get_data(as_text=True)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('<p>warble 100</p>', html)
+            self.assertNotIn('<p>warble 99</p>', html)
+            self.assertNotIn('id="load-more"', html)
+
+    def test_users_show_bad_cursor(self):
+        """test that a malformed cursor is rejected"""
+
+        with self.client as c:
+            resp = c.get(f'/users/{self.testuser.id}?before=garbage')
+
+            self.assertEqual(resp.status_code, 400)
+
+    def test_users_index_wrong_type_cursor(self):
+        """test that well-formed cursors with the wrong values are rejected"""
+
+        with self.client as c:
+            # ["x"], [1, 2], [true] and [2 ** 40] for a cursor on users.id
+            for cursor in ('WyJ4Il0', 'WzEsIDJd', 'W3RydWVd', 'WzEwOTk1MTE2Mjc3NzZd'):
+                resp = c.get(f'/users?before={cursor}')
+                self.assertEqual(resp.status_code, 400, cursor)
+
+            # [1.5] and ["x", 1] for a (timestamp, id) cursor on messages
+            for cursor in ('WzEuNV0', 'WyJ4IiwgMV0'):
+                resp = c.get(f'/users/{self.testuser.id}?before={cursor}')
+                self.assertEqual(resp.status_code, 400, cursor)
+
+    def test_users_show_not_modified(self):
+        """test that a repeat profile view is answered with a 304"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            resp = c.get(f'/users/{self.testuser.id}')
+            etag = resp.headers['ETag']
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertIn('private', resp.headers['Cache-Control'])
+            self.assertIn('no-cache', resp.headers['Cache-Control'])
+
+            resp = c.get(f'/users/{self.testuser.id}',
+                         headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 304)
+            self.assertEqual(resp.headers['ETag'], etag)
+            self.assertEqual(resp.get_data(), b'')
+
+            User.adjust_counts(self.testuser.id, messages_count=1)
+            db.session.commit()
+
+            resp = c.get(f'/users/{self.testuser.id}',
+                         headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotEqual(resp.headers['ETag'], etag)
+
+    def test_users_show_logged_out_is_public(self):
+        """test that anonymous profile views may be cached publicly"""
+
+        resp = self.client.get(f'/users/{self.testuser.id}')
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('public', resp.headers['Cache-Control'])
+        self.assertIn('Cookie', resp.headers['Vary'])
+
+    def test_following_page_etag_tracks_listed_users(self):
+        """test that editing a listed user changes the following page ETag"""
+
+        # the viewer isn't on the list, so only the listed user's version moves
+        viewer = User.signup("viewer", "viewer@test.com", "viewer", None)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = viewer.id
+
+            etag = c.get(f'/users/{self.testuser2.id}/following').headers['ETag']
+
+            User.query.get(self.testuser.id).bump_version()
+            db.session.commit()
+
+            resp = c.get(f'/users/{self.testuser2.id}/following',
+                         headers={'If-None-Match': etag})
+
+            self.assertEqual(resp.status_code, 200)
+
     def test_follower_page_logged_in(self):
         """test to see the following page of another user"""
 
@@ -127,6 +286,70 @@ class UserViewTestCaseLoggedIn(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('<p>@testuser</p>', html)
 
+    def test_follow_state_per_request(self):
+        """test that one user's follow state doesn't carry over to the next"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+            html = c.get('/users').get_data(as_text=True)
+            self.assertIn(f'action="/users/stop-following/{self.testuser.id}"', html)
+
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get('/users').get_data(as_text=True)
+            self.assertNotIn(f'action="/users/stop-following/{self.testuser.id}"', html)
+
+    def test_followers_page_streams(self):
+        """test that the followers page streams, with follow state and flashes"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+                sess['_flashes'] = [('success', 'Hello!')]
+
+            resp = c.get(f'/users/{self.testuser.id}/followers')
+            self.assertTrue(resp.is_streamed)
+            html = resp.get_data(as_text=True)
+
+            self.assertIn('<p>@testuser2</p>', html)
+            self.assertIn(f'action="/users/follow/{self.testuser2.id}"', html)
+            self.assertIn('Hello!', html)
+
+            c.post(f'/users/follow/{self.testuser2.id}')
+            html = c.get(f'/users/{self.testuser.id}/followers').get_data(as_text=True)
+
+            self.assertIn(f'action="/users/stop-following/{self.testuser2.id}"', html)
+            self.assertNotIn('Hello!', html)
+
+    def test_following_pages_by_follow_time(self):
+        """test that the following page is paged newest follow first"""
+
+        later = User.signup("testuser3", "test3@test.com", "testuser3", None)
+        db.session.flush()
+        db.session.add(Follows(user_being_followed_id=later.id,
+                               user_following_id=self.testuser2.id,
+                               created_at=datetime.utcnow() + timedelta(minutes=1)))
+        db.session.commit()
+
+        with self.client as c, mock.patch('app.USERS_PER_PAGE', 1):
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            html = c.get(f'/users/{self.testuser2.id}/following').get_data(as_text=True)
+            self.assertIn('<p>@testuser3</p>', html)
+            self.assertNotIn('<p>@testuser</p>', html)
+            self.assertIn(f'action="/users/follow/{later.id}"', html)
+
+            cursor = re.search(r'href="\?before=([^"]+)"', html).group(1)
+            html = c.get(f'/users/{self.testuser2.id}/following?before={cursor}'
+                         ).get_data(as_text=True)
+            self.assertIn('<p>@testuser</p>', html)
+            self.assertNotIn('<p>@testuser3</p>', html)
+            self.assertNotIn('id="load-more"', html)
+
     def test_follower_page_logged_out(self):
         """test to see the following page of another user logged out"""
 
@@ -153,6 +376,77 @@ class UserViewTestCaseLoggedIn(TestCase):
         self.assertEqual(resp.status_code, 200)
         self.assertIn('<p>@testuser2</p>', html)
 
+    def test_follow_backfills_home_timeline(self):
+        """test that following a user adds their messages to your home page"""
+
+        msg = Message(text="testuser2 message", user_id=self.testuser2.id)
+        db.session.add(msg)
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+        c.post(f'/users/follow/{self.testuser2.id}')
+        resp = c.get('/')
+        html = resp.get_data(as_text=True)
+
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn('<p>testuser2 message</p>', html)
+
+    def test_follow_after_fan_out(self):
+        """test that following keeps timeline rows a fan-out job already added"""
+
+        msg = Message(text="testuser2 message", user_id=self.testuser2.id)
+        db.session.add(msg)
+        db.session.flush()
+        db.session.add(HomeTimeline(user_id=self.testuser.id, message_id=msg.id,
+                                    author_id=self.testuser2.id,
+                                    timestamp=msg.timestamp))
+        db.session.commit()
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+            resp = c.post(f'/users/follow/{self.testuser2.id}')
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(HomeTimeline.query.filter_by(user_id=self.testuser.id).count(), 1)
+
+    def test_stop_follow_prunes_home_timeline(self):
+        """test that unfollowing a user removes their messages from your home page"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2.id
+
+        c.post(f'/users/stop-following/{self.testuser.id}')
+        c.post(f'/users/follow/{self.testuser.id}')
+        self.assertIn('<p>test message</p>', c.get('/').get_data(as_text=True))
+
+        c.post(f'/users/stop-following/{self.testuser.id}')
+        self.assertNotIn('<p>test message</p>', c.get('/').get_data(as_text=True))
+
+    def test_follow_updates_counts(self):
+        """test that following and unfollowing keep the counters in step"""
+
+        with self.client as c:
+            with c.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser.id
+
+        c.post(f'/users/follow/{self.testuser2.id}')
+        db.session.refresh(self.testuser)
+        db.session.refresh(self.testuser2)
+        self.assertEqual(self.testuser.following_count, 1)
+        self.assertEqual(self.testuser2.followers_count, 1)
+
+        c.post(f'/users/stop-following/{self.testuser2.id}')
+        db.session.refresh(self.testuser)
+        db.session.refresh(self.testuser2)
+        self.assertEqual(self.testuser.following_count, 0)
+        self.assertEqual(self.testuser2.followers_count, 0)
+
     def test_follow_logged_out(self):
         """test if you can follow user logged out"""
         with self.client as c:
@@ -0,0 +1,216 @@
+"""Cache of logged-in users, so add_user_to_g can skip the database.
+
+Run a cache shared by every worker on the host with:
+
+    python user_cache.py /tmp/warbler-users.sock
+
+and point the app at it with USER_CACHE_SOCKET=/tmp/warbler-users.sock.
+Without it, each worker keeps its own in-process cache.
+"""
+
+import argparse
+import json
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+
+from models import User
+
+
+class UserSnapshot:
+    """Detached, read-only copy of a user's columns.
+
+    Holds no session state, so it can be cached between requests and
+    reading it never touches the database. The read-only follow and like
+    helpers only need `id`, so they're shared with User.
+    """
+
+    FIELDS = (
+        'id', 'username', 'email', 'image_url', 'header_image_url', 'bio',
+        'location', 'messages_count', 'following_count', 'followers_count',
+        'likes_count', 'version',
+    )
+
+    __slots__ = FIELDS
+
+    def __init__(self, **fields):
+        for name in self.FIELDS:
+            setattr(self, name, fields[name])
+
+    def __repr__(self):
+        return f"<UserSnapshot #{self.id}: {self.username}>"
+
+    @classmethod
+    def from_user(cls, user):
+        """Snapshot the current column values of a `User`."""
+
+        return cls(**{name: getattr(user, name) for name in cls.FIELDS})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    is_following = User.is_following
+    is_followed_by = User.is_followed_by
+    following_ids_among = User.following_ids_among
+    follower_ids_among = User.follower_ids_among
+    liked_ids_among = User.liked_ids_among
+
+
+class NullUserCache:
+    """Cache that never hits; every request loads the user."""
+
+    def get(self, user_id):
+        return None
+
+    def set(self, snapshot):
+        pass
+
+    def invalidate(self, user_id):
+        pass
+
+
+class LocalUserCache:
+    """In-process LRU cache of user snapshots that expire after `ttl` seconds.
+
+    Entries are invalidated explicitly when a user changes; the TTL bounds
+    how stale counters changed by *other* users (e.g. followers) can get.
+    """
+
+    def __init__(self, maxsize=10_000, ttl=30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[user_id]
+                return None
+
+            self._entries.move_to_end(user_id)
+            return value
+
+    def set(self, snapshot):
+        self.put(snapshot.id, snapshot)
+
+    def put(self, user_id, value):
+        with self._lock:
+            self._entries[user_id] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(user_id)
+
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+
+class SocketUserCache:
+    """Client for a `UserCacheServer` shared by all workers on the host.
+
+    Any error talking to the server counts as a miss, so a missing or
+    restarted cache server slows requests down but never breaks them.
+    """
+
+    def __init__(self, path, timeout=0.05):
+        self.path = path
+        self.timeout = timeout
+
+    def get(self, user_id):
+        reply = self._call({'op': 'get', 'id': user_id})
+        value = reply and reply.get('value')
+
+        # snapshots cached by an older release may lack newer fields
+        if not value or not value.keys() >= set(UserSnapshot.FIELDS):
+            return None
+
+        return UserSnapshot(**value)
+
+    def set(self, snapshot):
+        self._call({'op': 'set', 'value': snapshot.to_dict()})
+
+    def invalidate(self, user_id):
+        self._call({'op': 'delete', 'id': user_id})
+
+    def _call(self, request):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.settimeout(self.timeout)
+                sock.connect(self.path)
+                sock.sendall(json.dumps(request).encode() + b'\n')
+                with sock.makefile('rb') as reply:
+                    return json.loads(reply.readline())
+
+        except (OSError, ValueError):
+            return None
+
+
+class UserCacheHandler(socketserver.StreamRequestHandler):
+    """Answer one JSON-lines request per connection line."""
+
+    def handle(self):
+        store = self.server.store
+
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                op = request['op']
+
+                if op == 'get':
+                    reply = {'value': store.get(request['id'])}
+                elif op == 'set':
+                    store.put(request['value']['id'], request['value'])
+                    reply = {'ok': True}
+                elif op == 'delete':
+                    store.invalidate(request['id'])
+                    reply = {'ok': True}
+                else:
+                    reply = {'error': f"unknown op {op!r}"}
+
+            except (KeyError, TypeError, ValueError):
+                reply = {'error': 'bad request'}
+
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+
+
+class UserCacheServer(socketserver.ThreadingUnixStreamServer):
+    """Unix-socket server holding user snapshots for every local worker."""
+
+    daemon_threads = True
+
+    def __init__(self, path, maxsize=100_000, ttl=30):
+        self.store = LocalUserCache(maxsize=maxsize, ttl=ttl)
+        super().__init__(path, UserCacheHandler)
+
+
+def make_user_cache(config):
+    """Build the user cache described by the app `config`."""
+
+    if not config['USER_CACHE_TTL']:
+        return NullUserCache()
+
+    if config['USER_CACHE_SOCKET']:
+        return SocketUserCache(config['USER_CACHE_SOCKET'])
+
+    return LocalUserCache(maxsize=config['USER_CACHE_SIZE'],
+                          ttl=config['USER_CACHE_TTL'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('socket', help="path of the unix socket to listen on")
+    parser.add_argument('--size', type=int, default=100_000)
+    parser.add_argument('--ttl', type=float, default=30)
+    args = parser.parse_args()
+
+    with UserCacheServer(args.socket, maxsize=args.size, ttl=args.ttl) as server:
+        server.serve_forever()